@@ -4,11 +4,14 @@ import json
 import sys
 import os
 import shutil
+import threading
 from jsonargparse import (ArgumentParser, namespace_to_dict)
-from xml.dom import minidom
 import internetarchive as ia
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor
+from job_db import JobDB
+from transfer import (transfer_file, TransferError)
+from governor import (Governor, show_throughput)
 
 
 def prepare_list_of_ids(all_ids_file, done_ids_file=None):
@@ -19,12 +22,12 @@ def prepare_list_of_ids(all_ids_file, done_ids_file=None):
     all_ids = [id.strip() for id in all_ids if not (id=="" or id is None)]
     f.close()
 
-    done_ids = []
+    done_ids = set()
     if done_ids_file is not None:
         f = open(done_ids_file, 'r')
         done_ids = f.readlines()
         done_ids = [id.replace("\n","") for id in done_ids]
-        done_ids = [id for id in done_ids if not (id=="" or id is None)]
+        done_ids = set(id for id in done_ids if not (id=="" or id is None))
         f.close()
 
     remaining_ids = []
@@ -37,154 +40,229 @@ def prepare_list_of_ids(all_ids_file, done_ids_file=None):
 
 def remove_dir(save_directory, identifier):
     print("---------------------------->", identifier, " failed <----------------------------\n")
+    if not os.path.exists(os.path.join(save_directory, identifier)):
+        return
     try:
         shutil.rmtree(os.path.join(save_directory, identifier))
     except:
         os.remove(os.path.join(save_directory, identifier))
 
 
-def download_captions(identifier, save_directory, file_elements):
-    # Find out if a caption file is downloadable
-    caption = ['cc5.txt', 'cc5.srt', 'asr.js', 'asr.srt', 'align.srt', 'align.json']
-    files = []
-    for c in caption:
-        files = files + [f.attributes['name'].value for f in file_elements \
-                         if f.attributes['name'].value.lower().endswith(c)]
+all_vid_extensions = ['.m4v', '.3gp', '.wmv', '.mkv', '.avi', '.flv', '.gif', '.3g2', '.webm', '.gifv', '.mpg', '.mp2', '.m2v', '.mpeg', '.mpe', '.mpv', '.amv', '.flv', '.f4v', '.f4p', '.f4a', '.f4b', '.vob', '.mts', '.m2ts', '.ts', '.mov', '.qt', '.yuv', '.rm', '.rmvb', '.svi']
+all_aud_extensions = ['.m4a', '.m4b', '.m4p', '.mp3', '.wav', '.rf64', '.webm', '.wv', '.raw', '.ra', '.rm', '.wma', '.3gp', '.aac', '.au', '.aiff', '.gsm', '.amr', '.awb', '.msv', '.nmf', '.aa', '.flac', '.aax', '.act', '.aiff', '.alac', '.mmf', '.opus', '.dfv', '.ape', '.dss', '.ogg', '.oga', '.mogg', '.8svx', '.voc', '.vox', '.sln', '.tta', '.cda', '.iklax', '.ivs']
+caption_suffixes = ['cc5.txt', 'cc5.srt', 'asr.js', 'asr.srt', 'align.srt', 'align.json']
+
+
+class FileClassifier:
+    # suffix -> {kind: rank} table built once. a lower rank is preferred: the mp4/mp3 derivatives first, then
+    # the original formats in the order of the extension lists above. suffixes listed as both video and audio
+    # have a rank of each kind and are classified as the first wanted kind, video when both are wanted.
+    def __init__(self, media='both'):
+        self.kinds = {'both': ['video', 'audio'], 'movies': ['video'], 'audio': ['audio']}[media]
+        self.media_rank = {}
+        for rank, ex in enumerate(['.mp4'] + all_vid_extensions):
+            self.media_rank.setdefault(ex[1:], {}).setdefault('video', rank)
+        for rank, ex in enumerate(['.mp3'] + all_aud_extensions):
+            self.media_rank.setdefault(ex[1:], {}).setdefault('audio', rank)
+
+        # caption suffixes span two dots, so they are grouped by their last extension and only those are compared
+        self.caption_rank = {}
+        for rank, suffix in enumerate(caption_suffixes):
+            self.caption_rank.setdefault(suffix.split('.')[-1], []).append((suffix, rank))
+
+    def classify(self, name):
+        name = name.lower()
+        ext = name.rsplit('.', 1)[-1]
+        for suffix, rank in self.caption_rank.get(ext, []):
+            if name.endswith(suffix):
+                return 'caption', rank
+        ranks = self.media_rank.get(ext, {})
+        for kind in self.kinds:
+            if kind in ranks:
+                return kind, ranks[kind]
+        return None, None
+
+    def select(self, file_names):
+        # one pass over the files of an item. returns the best caption file (or None) and the media files to
+        # download: every mp4/mp3 derivative if there is one, otherwise the files of the best ranked original
+        # extension of each wanted kind.
+        best_caption, caption_rank = None, None
+        best = {kind: (None, []) for kind in self.kinds}
+        derivatives = []
+        for name in file_names:
+            kind, rank = self.classify(name)
+            if kind == 'caption':
+                if (caption_rank is None) or (rank < caption_rank):
+                    best_caption, caption_rank = name, rank
+            elif kind in best:
+                if rank == 0:
+                    derivatives.append(name)
+                best_rank, names = best[kind]
+                if (best_rank is None) or (rank < best_rank):
+                    best[kind] = (rank, [name])
+                elif rank == best_rank:
+                    names.append(name)
+
+        if len(derivatives):
+            return best_caption, derivatives
+        return best_caption, [name for kind in self.kinds for name in best[kind][1]]
+
+
+def download_file(db, item, name, save_directory, segments=1, governor=None):
+    # resumable transfer of one file of the item, checked against the size and checksum of its metadata
+    f = item.get_file(name)
+    n_bytes, seconds = transfer_file(item.session, f.url, os.path.join(save_directory, item.identifier, name),
+                                     size=f.size, md5=f.md5, sha1=f.sha1, segments=segments, governor=governor)
+    if n_bytes:
+        db.record_transfer(item.identifier, name, n_bytes, seconds)
+
+
+def download_captions(db, item, save_directory, caption, governor=None):
+    try:
+        download_file(db, item, caption, save_directory, governor=governor)
+        return True
+    except Exception as e:
+        print(item.identifier, " failed caption download ", caption, e)
+    return False
 
-    # Download caption files
-    for file_ in files:
-        try:
-            ia.download(identifier, destdir=save_directory, glob_pattern=file_, ignore_existing=True,
-                        no_change_timestamp=True, ignore_errors=True)
-            return True
-        except:
-            print(identifier, " failed caption download ", file_)
 
-    return False
+def is_cc_licensed(metadata):
+    license = metadata.get('licenseurl', '')
+    if isinstance(license, list):
+        license = " ".join(license)
+    return 'creativecommons' in str(license).lower()
 
 
-def find_original_file(identifier, save_directory, file_elements, media):
-    print("---------------------------->No mp3/mp4 ", identifier, "<----------------------------------\n")
-    all_vid_extensions = ['.m4v', '.3gp', '.wmv', '.mkv', '.avi', '.flv', '.gif', '.3g2', '.webm', '.gifv', '.mpg', '.mp2', '.m2v', '.mpeg', '.mpe', '.mpv', '.amv', '.flv', '.f4v', '.f4p', '.f4a', '.f4b', '.vob', '.mts', '.m2ts', '.ts', '.mov', '.qt', '.yuv', '.rm', '.rmvb', '.svi']
-    all_aud_extensions = ['.m4a', '.m4b', '.m4p', '.mp3', '.wav', '.rf64', '.webm', '.wv', '.raw', '.ra', '.rm', '.wma', '.3gp', '.aac', '.au', '.aiff', '.gsm', '.amr', '.awb', '.msv', '.nmf', '.aa', '.flac', '.aax', '.act', '.aiff', '.alac', '.mmf', '.opus', '.dfv', '.ape', '.dss', '.ogg', '.oga', '.mogg', '.8svx', '.voc', '.vox', '.sln', '.tta', '.cda', '.iklax', '.ivs']
-
-    files = [f.attributes['name'].value for f in file_elements
-             if ( # ((f.attributes['source']).value == "original") and
-                 (not (f.attributes['name']).value.lower().endswith('.xml')) and
-                 (not (f.attributes['name']).value.lower().endswith('.sqlite')) and
-                 (not (f.attributes['name']).value.lower().endswith('.zip')) and
-                 (not (f.attributes['name']).value.lower().endswith('.torrent')) and
-                 (not (f.attributes['name']).value.lower().endswith('.txt')) and
-                 (not (f.attributes['name']).value.lower().endswith('.jpg')))]
-    if len(files) == 0:
-        remove_dir(save_directory, identifier)
-        return None
+def get_item_metadata(identifier, session=None, governor=None):
+    # item metadata and file list come from a single metadata api response; nothing is written to disk
+    governor = governor or Governor()
+    host = 'archive.org' if session is None else session.host
+    item = governor.call(host, ia.get_item, identifier, archive_session=session)
+    metadata = item.item_metadata.get('metadata', {})
+    file_names = [f['name'] for f in item.item_metadata.get('files', [])]
+    return item, metadata, file_names
 
-    files_all = files
-    files = []
 
-    if media in ['both', 'movies']:
-        for ex in all_vid_extensions:
-            files = files + [f for f in files_all if f.lower().endswith(ex)]
-    if media in ['both', 'audio']:
-        for ex in all_aud_extensions:
-            files = files + [f for f in files_all if f.lower().endswith(ex)]
+def download_item(db, item, file_names, save_directory, classifier, get_caption=True, segments=1, governor=None):
+    # caption and media stages of an item whose metadata passed. returns False if the item has no media to download
+    job = db.get(item.identifier)
+    caption, files = classifier.select(file_names)
 
-    if len(files) == 0:
-        print('no content')
-        remove_dir(save_directory, identifier)
-        return None
+    # download captions
+    if get_caption and not job['captions']:
+        if caption is not None:
+            download_captions(db, item, save_directory, caption, governor)
+        db.stage_done(item.identifier, 'captions')
 
-    return files
+    if not job['media']:
+        if len(files) == 0:
+            return False
 
+        # Download file with chosen extension
+        for name in files:
+            download_file(db, item, name, save_directory, segments, governor)
+        db.stage_done(item.identifier, 'media')
+    return True
 
-def is_cc_licensed(save_directory, identifier):
-    xml_file = [file_item for file_item in os.listdir(os.path.join(save_directory, identifier))
-                if file_item.endswith('_meta.xml')]
-    if len(xml_file) == 0:
-        return False
-    xml_file = minidom.parse(os.path.join(save_directory, identifier, xml_file[0]))
-    license = xml_file.getElementsByTagName('licenseurl')
 
-    if len(license):
-        license = license[0]
-        license = license.firstChild.data
+def read_ids(id_list_file):
+    if isinstance(id_list_file, str) and id_list_file.endswith('.txt'):
+        ids = prepare_list_of_ids(id_list_file)
+    else:
+        ids = []
+        with gzip.open(id_list_file, "rt") as fh:
+            for line in fh:
+                ids.append(json.loads(line)["identifier"])
+    return [m for m in ids if not (m == "" or m is None)]
 
-        if 'creativecommons' in str(license).lower():
-            return True
-    return False
 
+def download_data(id_list_file, save_directory, media='both', check_cc=True, get_caption=True, done_ids_file=None,
+                  db_path=None, workers=5, retry_failed=False, segments=1, max_bytes_per_second=None, max_per_host=10,
+                  session=None, governor=None):
+    # a caller running other stages against the archive passes its session and governor, so the limits are shared
+    classifier = FileClassifier(media)
+    governor = governor or Governor(max_bytes_per_second, max_per_host)
+    # one session for all items, so its connection pool is reused
+    session = session or ia.get_session()
+
+    def fail(identifier, reason):
+        print(identifier, reason)
+        remove_dir(save_directory, identifier)
+        db.fail(identifier, reason, reset_stages=True)
 
-def download_data(id_list_file, save_directory, media='both', check_cc=True, get_caption=True, done_ids_file=None):
     def get_data(identifier):
-        if os.path.exists(os.path.join(save_directory, identifier)):
-            remove_dir(save_directory, identifier)
-            return
+        job = db.get(identifier)
 
-        # download metadata (_files.xml, _meta.xml)
+        # metadata and file list of the item
         try:
-            ia.download(identifier, destdir=save_directory, glob_pattern="*_files.xml", ignore_existing=True, no_change_timestamp=True, ignore_errors=True)
-            ia.download(identifier, destdir=save_directory, glob_pattern="*_meta.xml", ignore_existing=True, no_change_timestamp=True, ignore_errors=True)
+            item, metadata, file_names = get_item_metadata(identifier, session, governor)
         except Exception as e:
-            print("missing xml")
-            remove_dir(save_directory, identifier)
+            fail(identifier, "missing metadata: {}".format(e))
             return
+        if len(metadata) == 0:
+            fail(identifier, "missing metadata")
+            return
+        db.stage_done(identifier, 'metadata')
 
-        # Read meta data
         try:
             # check if CC licensed
-            if check_cc and (not is_cc_licensed(save_directory, identifier)):
-                print("not cc")
-                remove_dir(save_directory, identifier)
-                return
+            if check_cc and not job['license']:
+                if not is_cc_licensed(metadata):
+                    fail(identifier, "not cc")
+                    return
+                db.stage_done(identifier, 'license')
 
-            xml_file = [f for f in os.listdir(os.path.join(save_directory, identifier)) if f.endswith('_files.xml')]
-            if len(xml_file) == 0:
-                print("missing files xml")
-                remove_dir(save_directory, identifier)
+            if not download_item(db, item, file_names, save_directory, classifier, get_caption, segments, governor):
+                print('no content')
+                fail(identifier, "no media")
                 return
 
-            xml_file = minidom.parse(os.path.join(save_directory, identifier, xml_file[0]))
-            xml_file = xml_file.getElementsByTagName("file")
-
-            # download captions
-            if get_caption:
-                download_captions(identifier, save_directory, xml_file)
-
-            # Find out if an mp3 or mp4 file is downloadable
-            files = [f.attributes['name'].value for f in xml_file \
-                     if ((media in ['both', 'audio']) * f.attributes['name'].value.lower().endswith('mp3')) \
-                     or ((media in ['both', 'movies']) * f.attributes['name'].value.lower().endswith('mp4'))]
-
-            # If no mp3 or mp4 file is downloadable then find out the original file extension
-            if len(files) == 0:
-                files = find_original_file(identifier, save_directory, xml_file, media)
-                if files is None:
-                    return
-
-            # Download file with chosen extension
-            for file_pat in files:
-                ia.download(identifier, destdir=save_directory, glob_pattern=file_pat, ignore_existing=True, no_change_timestamp=True, ignore_errors=True)
+            db.finish(identifier)
 
+        except TransferError as e:
+            # partial files are kept, a retry resumes them
+            print(identifier, e)
+            db.fail(identifier, e)
         except Exception as e:
             print('exceptipn', e)
-            remove_dir(save_directory, identifier)
+            fail(identifier, e)
 
     if (id_list_file is None) or (save_directory is None) or (not os.path.exists(id_list_file)):
         return
 
-    if isinstance(id_list_file, str) and id_list_file.endswith('.txt'):
-        ids = prepare_list_of_ids(id_list_file, done_ids_file)
-        ids = [m for m in ids if not (m == "" or m is None)]
-    else:
-        ids = []
-        with gzip.open(id_list_file, "rt") as fh:
-            for line in fh:
-                ids.append(json.loads(line)["identifier"])
-        ids = [m for m in ids if not (m == "" or m is None)]
+    # the job table lives next to the downloads unless a path is given
+    if db_path is None:
+        db_path = os.path.join(save_directory, "jobs.sqlite")
+    db = JobDB(db_path)
+    db.add(read_ids(id_list_file))
+    if done_ids_file is not None:
+        db.mark_done(prepare_list_of_ids(done_ids_file))
+    if retry_failed:
+        db.retry_failed()
+
+    n_pending = db.counts().get('pending', 0)
+    progress = tqdm(total=n_pending)
+    stop = threading.Event()
+    threading.Thread(target=show_throughput, args=(progress, governor, stop), daemon=True).start()
+
+    def worker():
+        while True:
+            identifier = db.claim()
+            if identifier is None:
+                return
+            get_data(identifier)
+            progress.update(1)
+
+    with ThreadPoolExecutor(workers) as executor:
+        for future in [executor.submit(worker) for _ in range(workers)]:
+            future.result()
+    stop.set()
+    progress.close()
 
-    with ThreadPoolExecutor(5) as executor:
-        list(tqdm(executor.map(get_data, ids), total=len(ids)))
+    n_files, n_bytes, seconds = db.transfer_totals()
+    print(n_files, "files,", round(n_bytes / 1e6, 1), "MB,", round(n_bytes / 1e6 / max(seconds, 1e-9), 2), "MB/s per transfer")
+    print(db.counts())
+    db.close()
 
 
 if __name__ == '__main__':
@@ -195,6 +273,12 @@ if __name__ == '__main__':
     parser.add_argument('-l', '--check_cc', default=True, help='To download CC-licensed content only', type=bool, required=False)
     parser.add_argument('-c', '--get_caption', default=True, help='To download captions if available', type=bool, required=False)
     parser.add_argument('-a', '--done_ids_file', default=None, help='path to file containing list of ids that are already downloaded', type=str, required=False)
+    parser.add_argument('-b', '--db_path', default=None, help='path of the sqlite job table. defaults to <save_directory>/jobs.sqlite', type=str, required=False)
+    parser.add_argument('-w', '--workers', default=5, help='number of parallel downloads', type=int, required=False)
+    parser.add_argument('-r', '--retry_failed', default=False, help='claim identifiers that failed in an earlier run again', type=bool, required=False)
+    parser.add_argument('-s', '--segments', default=1, help='parallel range requests per large media file', type=int, required=False)
+    parser.add_argument('--max_bytes_per_second', default=None, help='bandwidth cap over all downloads', type=float, required=False)
+    parser.add_argument('--max_per_host', default=10, help='most requests in flight to one host; the governor starts at half and adapts', type=int, required=False)
 
     args = parser.parse_args()
     download_data(**namespace_to_dict(args))
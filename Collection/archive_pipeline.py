@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+import os
+import queue
+import threading
+from tqdm import tqdm
+import internetarchive as ia
+from jsonargparse import (ArgumentParser, namespace_to_dict)
+from job_db import JobDB
+from archive_search import get_query
+from archive_download import (FileClassifier, remove_dir, is_cc_licensed, get_item_metadata, download_item)
+from transfer import TransferError
+from governor import (Governor, show_throughput, status_of)
+
+
+def get_session(host=None):
+    # host is for a local fake search/metadata/download server (e.g. 127.0.0.1:8000), reached over plain http
+    if host is None:
+        return ia.get_session()
+    session = ia.get_session(config={'general': {'secure': False}})
+    session.host = host
+    return session
+
+
+def search_identifiers(query, session, governor):
+    # the search requests its pages inside next(), so each next() takes a slot of the host like the metadata
+    # requests and the transfers do. only failures are reported: most next() calls make no request, and counting
+    # them as successes would raise the limit of the host too fast
+    results = ia.search_items(query, fields=['identifier'], archive_session=session).iter_as_results()
+    while True:
+        with governor.slot(session.host):
+            try:
+                result = next(results, None)
+            except Exception as e:
+                governor.report(session.host, status_of(e))
+                raise
+        if result is None:
+            return
+        yield result['identifier']
+
+
+def run_pipeline(save_directory, save_file=None, query=None, media='both', check_cc=True, get_caption=True,
+                 db_path=None, metadata_workers=15, download_workers=5, queue_size=100, retry_failed=False,
+                 host=None, segments=1, max_bytes_per_second=None, max_per_host=20):
+    # search results stream through two bounded queues: identifiers -> metadata/licence workers -> download
+    # workers. a full queue blocks the stage before it, so the search only runs ahead of the downloads by
+    # 2 * queue_size items, and the first download starts as soon as the first accepted item is found.
+    if query is None:
+        query = get_query()
+    if db_path is None:
+        db_path = os.path.join(save_directory, "jobs.sqlite")
+    os.makedirs(save_directory, exist_ok=True)
+    db = JobDB(db_path)
+    session = get_session(host)
+    classifier = FileClassifier(media)
+    # one governor for the search pages, the metadata requests and the transfers of all workers
+    governor = Governor(max_bytes_per_second, max_per_host)
+
+    ids_queue = queue.Queue(queue_size)
+    items_queue = queue.Queue(queue_size)
+    save_lock = threading.Lock()
+    stats = {'found': 0, 'skipped': 0, 'accepted': 0}
+    progress = tqdm(desc="downloaded")
+    # an exception that ends a worker is kept for the main thread, which raises it once every stage has
+    # stopped. the metadata and download workers then only drain their queue, so no stage blocks on a full one
+    errors = []
+    aborted = threading.Event()
+    n_metadata_running = [metadata_workers]
+    running_lock = threading.Lock()
+
+    def abort(e, from_queue):
+        print("worker failed", e)
+        errors.append(e)
+        aborted.set()
+        while from_queue.get() is not None:
+            pass
+
+    def fail(identifier, reason):
+        print(identifier, reason)
+        remove_dir(save_directory, identifier)
+        db.fail(identifier, reason, reset_stages=True)
+
+    def search_worker():
+        try:
+            for identifier in search_identifiers(query, session, governor):
+                if aborted.is_set():
+                    break
+                stats['found'] += 1
+                job = db.get(identifier)
+                if (job is not None) and ((job['status'] == 'done') or (job['status'] == 'failed' and not retry_failed)):
+                    stats['skipped'] += 1
+                    continue
+                db.add([identifier])
+                ids_queue.put(identifier)
+        except Exception as e:
+            # the items found so far are still downloaded
+            print("search failed", e)
+            errors.append(e)
+        finally:
+            for _ in range(metadata_workers):
+                ids_queue.put(None)
+
+    def metadata_worker():
+        try:
+            while True:
+                identifier = ids_queue.get()
+                if identifier is None:
+                    return
+                if aborted.is_set():
+                    continue
+                try:
+                    item, metadata, file_names = get_item_metadata(identifier, session, governor)
+                except Exception as e:
+                    fail(identifier, "missing metadata: {}".format(e))
+                    continue
+                if len(metadata) == 0:
+                    fail(identifier, "missing metadata")
+                    continue
+                db.stage_done(identifier, 'metadata')
+
+                if check_cc:
+                    if not is_cc_licensed(metadata):
+                        fail(identifier, "not cc")
+                        continue
+                    db.stage_done(identifier, 'license')
+
+                with save_lock:
+                    stats['accepted'] += 1
+                    if save_file is not None:
+                        with open(save_file, "a") as filew:
+                            filew.write(identifier + " " + str(metadata.get('licenseurl', '')) + "\n")
+                items_queue.put((item, file_names))
+        except Exception as e:
+            abort(e, ids_queue)
+        finally:
+            # the last metadata worker to stop ends the download stage
+            with running_lock:
+                n_metadata_running[0] -= 1
+                last = n_metadata_running[0] == 0
+            if last:
+                for _ in range(download_workers):
+                    items_queue.put(None)
+
+    def download_worker():
+        try:
+            while True:
+                entry = items_queue.get()
+                if entry is None:
+                    return
+                if aborted.is_set():
+                    continue
+                item, file_names = entry
+                try:
+                    if download_item(db, item, file_names, save_directory, classifier, get_caption, segments, governor):
+                        db.finish(item.identifier)
+                    else:
+                        print('no content')
+                        fail(item.identifier, "no media")
+                except TransferError as e:
+                    # partial files are kept, a retry resumes them
+                    print(item.identifier, e)
+                    db.fail(item.identifier, e)
+                except Exception as e:
+                    print('exception', e)
+                    fail(item.identifier, e)
+                progress.update(1)
+        except Exception as e:
+            abort(e, items_queue)
+
+    searcher = threading.Thread(target=search_worker, daemon=True)
+    metadata_threads = [threading.Thread(target=metadata_worker, daemon=True) for _ in range(metadata_workers)]
+    download_threads = [threading.Thread(target=download_worker, daemon=True) for _ in range(download_workers)]
+    stop = threading.Event()
+    monitor = threading.Thread(target=show_throughput, daemon=True,
+                               args=(progress, governor, stop, lambda: {'found': stats['found'], 'accepted': stats['accepted']}))
+    for t in [searcher, monitor] + metadata_threads + download_threads:
+        t.start()
+
+    searcher.join()
+    for t in metadata_threads:
+        t.join()
+    for t in download_threads:
+        t.join()
+    stop.set()
+    progress.close()
+
+    print("found {found}, already handled {skipped}, accepted {accepted}".format(**stats))
+    n_files, n_bytes, seconds = db.transfer_totals()
+    print(n_files, "files,", round(n_bytes / 1e6, 1), "MB,", round(n_bytes / 1e6 / max(seconds, 1e-9), 2), "MB/s per transfer")
+    print(db.counts())
+    db.close()
+    if len(errors):
+        raise errors[0]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Search the archive and download the results as they are found")
+    parser.add_argument('-d', '--save_directory', help='path of directory to save files', type=str, required=True)
+    parser.add_argument('-f', '--save_file', default=None, help="path of file to append accepted ids to", type=str, required=False)
+    parser.add_argument('-q', '--query', default=None, help='search query. defaults to the query of archive_search', type=str, required=False)
+    parser.add_argument('-m', '--media', default='both', help='Media type. options: audio, movies, both', type=str, required=False)
+    parser.add_argument('-l', '--check_cc', default=True, help='To download CC-licensed content only', type=bool, required=False)
+    parser.add_argument('-c', '--get_caption', default=True, help='To download captions if available', type=bool, required=False)
+    parser.add_argument('-b', '--db_path', default=None, help='path of the sqlite job table. defaults to <save_directory>/jobs.sqlite', type=str, required=False)
+    parser.add_argument('--metadata_workers', default=15, help='number of parallel metadata requests', type=int, required=False)
+    parser.add_argument('-w', '--download_workers', default=5, help='number of parallel downloads', type=int, required=False)
+    parser.add_argument('--queue_size', default=100, help='items buffered between the stages', type=int, required=False)
+    parser.add_argument('-r', '--retry_failed', default=False, help='process identifiers that failed in an earlier run again', type=bool, required=False)
+    parser.add_argument('-s', '--segments', default=1, help='parallel range requests per large media file', type=int, required=False)
+    parser.add_argument('--max_bytes_per_second', default=None, help='bandwidth cap over all downloads', type=float, required=False)
+    parser.add_argument('--max_per_host', default=20, help='most requests in flight to one host; the governor starts at half and adapts', type=int, required=False)
+    parser.add_argument('--host', default=None, help='host[:port] of a local archive stand-in, used over http', type=str, required=False)
+
+    args = parser.parse_args()
+    run_pipeline(**namespace_to_dict(args))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
-
+import os
 from tqdm import tqdm
 import internetarchive as ia
 from jsonargparse import (ArgumentParser, namespace_to_dict)
 from concurrent.futures import ThreadPoolExecutor
+from seen_index import SeenIndex
+from governor import Governor
 
 
 def get_query():
@@ -19,59 +21,187 @@ def get_query():
                  'egyptian american', 'libyan american', 'algerian american']
 
     query = '(mediatype:movies OR mediatype:audio) AND ('
-    for i, c in enumerate(content):
-        if i:
-            query += ' OR '
-        query += '(title:(' + c + ') OR description:(' + c + ') OR creator:(' + c + ') OR subject:(' + c + '))'
+    query += ' OR '.join(field_clause(c) for c in content)
     query += ') AND ('
-    for i, keyword in enumerate(keywords):
-        if i:
-            query += ' OR '
-        query += '(title:(' + keyword + ') OR description:(' + keyword + ') OR creator:(' + keyword + ') OR subject:(' + c + '))'
+    query += ' OR '.join(field_clause(keyword) for keyword in keywords)
     query += ') AND (NOT access-restricted-item:TRUE)'
 
     return query
 
 
-def archive_search(save_file, check_cc=True):
-    query = get_query()
-    search = ia.search_items(query)
-    all_results = list(tqdm(search.iter_as_results()))
-    print("Number of results found: ", len(all_results))
+def field_clause(term):
+    return '(title:(' + term + ') OR description:(' + term + ') OR creator:(' + term + ') OR subject:(' + term + '))'
+
+
+def load_keywords(keywords_file):
+    # file order, without blank lines and repeated phrases
+    with open(keywords_file, 'r') as f:
+        keywords = dict.fromkeys(line.strip() for line in f)
+    return [keyword for keyword in keywords if keyword != ""]
+
+
+def get_shard_queries(keywords, shard_size=10):
+    # the phrases of the keyword file already name the content type, so each shard only ORs its phrases
+    queries = []
+    for i in range(0, len(keywords), shard_size):
+        query = '(mediatype:movies OR mediatype:audio) AND ('
+        query += ' OR '.join(field_clause(keyword) for keyword in keywords[i:i + shard_size])
+        query += ') AND (NOT access-restricted-item:TRUE)'
+        queries.append(query)
+    return queries
+
+
+def add_watermark(query, date_field, watermark):
+    if watermark is None:
+        return query
+    # whole days only; the overlap with the previous run is dropped by the seen index
+    return '(' + query + ') AND ' + date_field + ':[' + watermark[:10] + ' TO null]'
+
+
+def search_query(query, watermark, date_field, session):
+    # every shard pages through its own results
+    search = ia.search_items(add_watermark(query, date_field, watermark), fields=['identifier', date_field],
+                             archive_session=session)
+    newest = watermark
+    results = []
+    for result in search.iter_as_results():
+        date = result.get(date_field)
+        if isinstance(date, list):
+            date = max(date)
+        if date and ((newest is None) or (str(date) > newest)):
+            newest = str(date)
+        results.append(result)
+    return results, newest
+
+
+def run_shards(queries, watermarks, date_field, session, workers=4, retries=3, governor=None):
+    # returns {shard: (results, newest date)} for the shards that finished and {shard: error} for the rest.
+    # shards that fail are retried on their own, up to retries more times.
+    done, failed = {}, {}
+    attempts = [0] * len(queries)
+    governor = governor or Governor()
+
+    def run(i):
+        attempts[i] += 1
+        try:
+            # a shard holds one of the host's slots while it pages through its results
+            return i, governor.call(session.host, search_query, queries[i], watermarks[i], date_field, session), None
+        except Exception as e:
+            return i, None, e
+
+    todo = list(range(len(queries)))
+    for attempt in range(retries + 1):
+        if len(todo) == 0:
+            break
+        if attempt:
+            print("retrying", len(todo), "failed shards")
+        with ThreadPoolExecutor(workers) as executor:
+            for i, out, error in tqdm(executor.map(run, todo), total=len(todo)):
+                if error is None:
+                    done[i] = out
+                    failed.pop(i, None)
+                else:
+                    print("shard", i, "failed:", error)
+                    failed[i] = error
+        todo = sorted(failed)
+    return done, failed, attempts
+
+
+def archive_search(save_file, check_cc=True, index_path=None, date_field='addeddate', full_refresh=False,
+                   keywords_file=None, shard_size=10, shard_workers=4, shard_retries=3, max_per_host=30, session=None,
+                   governor=None):
+    # one query built from the lists in get_query, or one query per shard of the keyword file
+    if keywords_file is None:
+        queries = [get_query()]
+    else:
+        queries = get_shard_queries(load_keywords(keywords_file), shard_size)
+    # a caller running other stages against the archive passes its session and governor, so the limits are shared
+    session = session or ia.get_session()
+    governor = governor or Governor(max_per_host=max_per_host)
+
+    # identifiers handled by earlier runs, seeded from the save file the first time
+    if index_path is None:
+        index_path = save_file + ".seen.sqlite"
+    index = SeenIndex(index_path)
+    if len(index) == 0 and os.path.exists(save_file):
+        with open(save_file, 'r') as file_r:
+            index.add([line.split()[0] for line in file_r if line.strip() != ""], accepted=True)
+
+    watermarks = [None if full_refresh else index.get_watermark(query) for query in queries]
+    print("searching", len(queries), "queries with", date_field, "since", min([w for w in watermarks if w] or [None]))
+    done, failed, attempts = run_shards(queries, watermarks, date_field, session, shard_workers, shard_retries, governor)
+
+    # deduplicate across shards and against the index
+    new_results = {}
+    n_results = 0
+    report = []
+    for i in sorted(done):
+        results, _ = done[i]
+        n_results += len(results)
+        n_new = 0
+        for result in results:
+            if result["identifier"] not in index and result["identifier"] not in new_results:
+                new_results[result["identifier"]] = result
+                n_new += 1
+        report.append((i, len(results), n_new, attempts[i]))
+    new_results = list(new_results.values())
+    print("Number of results found: ", n_results, " new: ", len(new_results))
 
     def get_metadata(result):
-        item = ia.get_item(result["identifier"], archive_session=search.session)
-        metadata = (item.item_metadata)['metadata']
-        return metadata
-
-    with ThreadPoolExecutor(15) as executor:
-        metadata_list = list(tqdm(executor.map(get_metadata, all_results), total=len(all_results)))
-
-    try:
-        file_r = open(save_file, 'r')
-        unique_metadata = file_r.readlines()
-        unique_metadata = [id.replace("\n", "") for id in unique_metadata]
-        unique_metadata = [id for id in unique_metadata if not (id == "" or id is None)]
-        file_r.close()
-    except:
-        print("new file")
-        unique_metadata = []
+        try:
+            item = governor.call(session.host, ia.get_item, result["identifier"], archive_session=session)
+            return (item.item_metadata)['metadata']
+        except Exception as e:
+            print(result["identifier"], "missing metadata", e)
+            return None
+
+    with ThreadPoolExecutor(max_per_host) as executor:
+        metadata_list = list(tqdm(executor.map(get_metadata, new_results), total=len(new_results)))
 
     filew = open(save_file, "a")
-    for metadata in metadata_list:
+    n_failed = 0
+    for result, metadata in zip(new_results, metadata_list):
+        identifier = result["identifier"]
+        if metadata is None:
+            # not recorded as seen, so the next run asks again
+            n_failed += 1
+            continue
         if check_cc and ('licenseurl' in metadata.keys()) and ('creativecommons' in str(metadata['licenseurl']).lower()):
-            if metadata["identifier"] not in unique_metadata:
-                unique_metadata.append(metadata["identifier"])
-                filew.write(metadata["identifier"] + " " + metadata['licenseurl'])
-                filew.write("\n")
+            filew.write(identifier + " " + metadata['licenseurl'])
+            filew.write("\n")
+            index.add([identifier], accepted=True)
+        else:
+            index.add([identifier])
     filew.close()
-    print("\ntotal len ", len(unique_metadata))
+
+    # a watermark only moves once every item up to it has been handled
+    if n_failed == 0:
+        for i, (_, newest) in done.items():
+            if newest is not None:
+                index.set_watermark(queries[i], newest)
+
+    if len(queries) > 1:
+        print("\nshard  hits  new  attempts")
+        for i, n_hits, n_new, n_attempts in report:
+            print(i, n_hits, n_new, n_attempts)
+        for i in sorted(failed):
+            print(i, "failed after", attempts[i], "attempts:", failed[i])
+    print("\ntotal seen ", len(index))
+    index.close()
 
 
 if __name__ == '__main__':
     parser = ArgumentParser(description="Download files from archive")
     parser.add_argument('-f', '--save_file', help="path to save file containing list of ids ", type=str, required=True)
     parser.add_argument('-l', '--check_cc', default=True, help='To download CC-licensed content only', type=bool, required=False)
+    parser.add_argument('-i', '--index_path', default=None, help='path of the seen-identifier index. defaults to <save_file>.seen.sqlite', type=str, required=False)
+    parser.add_argument('--date_field', default='addeddate', help='date field the search watermark follows (addeddate or publicdate)', type=str, required=False)
+    parser.add_argument('-k', '--keywords_file', default=None, help='search one shard of phrases of this file at a time, e.g. keywords.txt', type=str, required=False)
+    parser.add_argument('--shard_size', default=10, help='number of keyword phrases per shard query', type=int, required=False)
+    parser.add_argument('--shard_workers', default=4, help='number of shards searched at once', type=int, required=False)
+    parser.add_argument('--shard_retries', default=3, help='times a failed shard is searched again', type=int, required=False)
+    parser.add_argument('--max_per_host', default=30, help='most requests in flight to archive.org; the governor starts at half and adapts', type=int, required=False)
+    parser.add_argument('--full_refresh', default=False, help='ignore the watermark and search everything again', type=bool, required=False)
 
     args = parser.parse_args()
     archive_search(**namespace_to_dict(args))
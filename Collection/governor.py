@@ -0,0 +1,118 @@
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+
+BACK_OFF_STATUS = (429, 503)
+
+
+def status_of(error):
+    # http status of a failed request. internetarchive re-raises errors without the response, so the status is
+    # also looked for in the message
+    response = getattr(error, 'response', None)
+    if response is not None:
+        return response.status_code
+    for status in BACK_OFF_STATUS:
+        if str(status) in str(error):
+            return status
+    return None
+
+
+class Governor:
+    # limits shared by every request of a run: a token bucket over the bytes per second of all transfers,
+    # and a number of requests in flight per host. that number starts at half of max_per_host, is halved
+    # when a host answers 429/503 and grows by one after as many successes in a row as it currently allows.
+    def __init__(self, bytes_per_second=None, max_per_host=None):
+        self.bytes_per_second = bytes_per_second
+        self.max_per_host = max_per_host
+        self.cond = threading.Condition()
+        self.in_flight = defaultdict(int)
+        self.limit = {}
+        self.successes = defaultdict(int)
+
+        self.tokens = bytes_per_second
+        self.last = time.monotonic()
+        self.bucket_lock = threading.Lock()
+        self.window = deque()
+        self.window_seconds = 5.0
+
+    def get_limit(self, host):
+        if host not in self.limit:
+            self.limit[host] = max(1, self.max_per_host // 2)
+        return self.limit[host]
+
+    @contextmanager
+    def slot(self, host):
+        if self.max_per_host is None:
+            yield
+            return
+        with self.cond:
+            while self.in_flight[host] >= self.get_limit(host):
+                self.cond.wait()
+            self.in_flight[host] += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight[host] -= 1
+                self.cond.notify_all()
+
+    def report(self, host, status):
+        if self.max_per_host is None:
+            return
+        with self.cond:
+            limit = self.get_limit(host)
+            if status in BACK_OFF_STATUS:
+                self.limit[host] = max(1, limit // 2)
+                self.successes[host] = 0
+                print(host, "answered", status, "- requests in flight lowered to", self.limit[host])
+            elif (status is not None) and (status < 400):
+                self.successes[host] += 1
+                if self.successes[host] >= limit and limit < self.max_per_host:
+                    self.limit[host] = limit + 1
+                    self.successes[host] = 0
+                    self.cond.notify_all()
+
+    def call(self, host, fn, *args, **kwargs):
+        # fn(*args, **kwargs) as one request to host
+        with self.slot(host):
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.report(host, status_of(e))
+                raise
+            self.report(host, 200)
+            return result
+
+    def consume(self, n_bytes):
+        now = time.monotonic()
+        with self.bucket_lock:
+            self.window.append((now, n_bytes))
+            while self.window[0][0] < now - self.window_seconds:
+                self.window.popleft()
+            if self.bytes_per_second is None:
+                return
+            # the bucket may go into debt for a large block, the caller then waits until it is paid back
+            self.tokens = min(self.bytes_per_second, self.tokens + (now - self.last) * self.bytes_per_second)
+            self.last = now
+            self.tokens -= n_bytes
+            wait = -self.tokens / self.bytes_per_second if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def rate(self):
+        # bytes per second over the last few seconds
+        now = time.monotonic()
+        with self.bucket_lock:
+            n_bytes = sum(n for t, n in self.window if t >= now - self.window_seconds)
+        return n_bytes / self.window_seconds
+
+
+def show_throughput(progress, governor, stop, extra=None, interval=1.0):
+    # keeps the live transfer rate (and whatever extra() returns) in the postfix of a tqdm bar until stop is set
+    while not stop.wait(interval):
+        postfix = {'MB/s': round(governor.rate() / 1e6, 2)}
+        if extra is not None:
+            postfix.update(extra())
+        progress.set_postfix(postfix)
@@ -0,0 +1,109 @@
+import os
+import time
+import sqlite3
+import threading
+
+
+STAGES = ['metadata', 'license', 'captions', 'media']
+# stages whose output is the files of the item directory
+FILE_STAGES = ['captions', 'media']
+
+
+class JobDB:
+    # sqlite table with one row per identifier: its status (pending, running, done, failed), the failure reason
+    # and which stages of the download already finished, so that a restarted run continues where it stopped
+    def __init__(self, path):
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (identifier TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                          "reason TEXT, " + ", ".join(s + " INTEGER DEFAULT 0" for s in STAGES) + ", updated REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS transfers (identifier TEXT, name TEXT, bytes INTEGER, "
+                          "seconds REAL, updated REAL)")
+        # jobs that were running when the previous run stopped are claimed again
+        self.conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+        self.conn.commit()
+
+    def add(self, identifiers, status='pending'):
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO jobs (identifier, status, updated) VALUES (?, ?, ?)",
+                                  ((identifier, status, time.time()) for identifier in identifiers))
+            self.conn.commit()
+
+    def mark_done(self, identifiers):
+        with self.lock:
+            self.conn.executemany("INSERT INTO jobs (identifier, status, updated) VALUES (?, 'done', ?) "
+                                  "ON CONFLICT(identifier) DO UPDATE SET status = 'done'",
+                                  ((identifier, time.time()) for identifier in identifiers))
+            self.conn.commit()
+
+    def retry_failed(self):
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = 'pending', reason = NULL WHERE status = 'failed'")
+            self.conn.commit()
+
+    def claim(self):
+        with self.lock:
+            row = self.conn.execute("SELECT identifier FROM jobs WHERE status = 'pending' LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE jobs SET status = 'running', updated = ? WHERE identifier = ?",
+                              (time.time(), row[0]))
+            self.conn.commit()
+            return row[0]
+
+    def get(self, identifier):
+        with self.lock:
+            cursor = self.conn.execute("SELECT * FROM jobs WHERE identifier = ?", (identifier,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([c[0] for c in cursor.description], row))
+
+    def has_stage(self, identifier, stage):
+        job = self.get(identifier)
+        return (job is not None) and bool(job[stage])
+
+    def stage_done(self, identifier, stage):
+        if stage not in STAGES:
+            raise ValueError("unknown stage: {}".format(stage))
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET {} = 1, updated = ? WHERE identifier = ?".format(stage),
+                              (time.time(), identifier))
+            self.conn.commit()
+
+    def finish(self, identifier):
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = 'done', updated = ? WHERE identifier = ?",
+                              (time.time(), identifier))
+            self.conn.commit()
+
+    def fail(self, identifier, reason, reset_stages=False):
+        # reset_stages when the item directory is removed, so that a retry downloads its files again
+        resets = "".join(", {} = 0".format(s) for s in FILE_STAGES) if reset_stages else ""
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = 'failed', reason = ?, updated = ?" + resets +
+                              " WHERE identifier = ?", (str(reason), time.time(), identifier))
+            self.conn.commit()
+
+    def record_transfer(self, identifier, name, n_bytes, seconds):
+        with self.lock:
+            self.conn.execute("INSERT INTO transfers (identifier, name, bytes, seconds, updated) VALUES (?, ?, ?, ?, ?)",
+                              (identifier, name, n_bytes, seconds, time.time()))
+            self.conn.commit()
+
+    def transfer_totals(self):
+        # (files, bytes, seconds spent in transfers) over all recorded transfers
+        with self.lock:
+            n, n_bytes, seconds = self.conn.execute("SELECT COUNT(*), SUM(bytes), SUM(seconds) FROM transfers").fetchone()
+            return n, n_bytes or 0, seconds or 0.0
+
+    def counts(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+import os
+import json
+import shutil
+import subprocess
+from tqdm import tqdm
+from jsonargparse import (ArgumentParser, namespace_to_dict)
+from concurrent.futures import (ProcessPoolExecutor, as_completed)
+from archive_download import FileClassifier
+from transfer import file_hash
+
+
+def find_media(save_directory, skip_paths):
+    # (path, kind) of the audio/video files in the item directories of save_directory
+    classifier = FileClassifier('both')
+    media = []
+    for identifier in sorted(os.listdir(save_directory)):
+        item_directory = os.path.join(save_directory, identifier)
+        if not os.path.isdir(item_directory):
+            continue
+        for name in sorted(os.listdir(item_directory)):
+            path = os.path.join(item_directory, name)
+            kind, _ = classifier.classify(name)
+            if kind in ('audio', 'video') and path not in skip_paths:
+                media.append((path, kind))
+    return media
+
+
+def hash_file(path):
+    return path, file_hash(path, 'md5')
+
+
+def write_record(fw, h, source, output):
+    # size and mtime of the source let the next run reuse its hash instead of reading the file again
+    stat = os.stat(source)
+    fw.write(json.dumps({"hash": h, "source": source, "output": output, "size": stat.st_size,
+                         "mtime": stat.st_mtime}) + "\n")
+    fw.flush()
+
+
+def convert(source, output, sample_rate=16000):
+    # runs in a worker process. ffmpeg writes to a temporary name that is only moved into place when it succeeds
+    temp = output + '.tmp' + os.path.splitext(output)[1]
+    command = ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', source, '-vn', '-ac', '1', '-ar', str(sample_rate), temp]
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return source, output, result.stderr.decode('utf-8', 'replace').strip()[-500:]
+    os.replace(temp, output)
+    return source, output, None
+
+
+def normalize_media(save_directory, output_directory=None, sample_rate=16000, audio_format='flac', workers=None,
+                    delete_video=False, manifest_path=None):
+    # transcodes the downloaded media to mono audio at sample_rate. the md5 of every converted source is kept
+    # in an append-only jsonl manifest, so a source (or a copy of it under another item) is converted only once.
+    if shutil.which('ffmpeg') is None:
+        print("ffmpeg not found on PATH")
+        return
+    if output_directory is None:
+        output_directory = save_directory
+    if manifest_path is None:
+        manifest_path = os.path.join(output_directory, "normalized.jsonl")
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    converted = {}
+    hashed = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as fr:
+            for line in fr:
+                try:
+                    record = json.loads(line)
+                    converted[record["hash"]] = record["output"]
+                    if "size" in record:
+                        hashed[record["source"]] = (record["size"], record["mtime"], record["hash"])
+                except ValueError:
+                    pass
+
+    media = find_media(save_directory, set(converted.values()))
+    kinds = dict(media)
+    print(len(media), "media files found")
+
+    # only files that are new or changed since the manifest recorded their hash are read
+    hashes = {}
+    for path, _ in media:
+        stat = os.stat(path)
+        size, mtime, h = hashed.get(path, (None, None, None))
+        if (size == stat.st_size) and (mtime == stat.st_mtime):
+            hashes[path] = h
+    to_hash = [path for path, _ in media if path not in hashes]
+    print(len(media) - len(to_hash), "unchanged,", len(to_hash), "to hash")
+
+    with ProcessPoolExecutor(workers) as executor, open(manifest_path, 'a') as fw:
+        hashes.update(tqdm(executor.map(hash_file, to_hash, chunksize=8), total=len(to_hash)))
+        new_hashes = set(to_hash)
+
+        jobs = {}
+        # copies of a source converted in this run, recorded once its conversion succeeded
+        waiting = {}
+        n_skipped = 0
+        for path, _ in media:
+            h = hashes[path]
+            if h in jobs:
+                n_skipped += 1
+                if path in new_hashes:
+                    waiting.setdefault(h, []).append(path)
+                continue
+            if h in converted and os.path.exists(converted[h]):
+                n_skipped += 1
+                if path in new_hashes:
+                    write_record(fw, h, path, converted[h])
+                continue
+            identifier = os.path.basename(os.path.dirname(path))
+            stem = os.path.splitext(os.path.basename(path))[0]
+            output = os.path.join(output_directory, identifier, '{}.{}k.{}'.format(stem, sample_rate // 1000, audio_format))
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            jobs[h] = (path, output)
+        print(n_skipped, "already converted,", len(jobs), "to convert")
+
+        futures = {executor.submit(convert, path, output, sample_rate): h for h, (path, output) in jobs.items()}
+        n_failed = 0
+        freed = 0
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            source, output, error = future.result()
+            if error is not None:
+                print(source, "failed:", error)
+                n_failed += 1
+                continue
+            write_record(fw, futures[future], source, output)
+            for path in waiting.get(futures[future], []):
+                write_record(fw, futures[future], path, output)
+            if delete_video and kinds[source] == 'video':
+                freed += os.path.getsize(source)
+                os.remove(source)
+
+    print(len(jobs) - n_failed, "converted,", n_failed, "failed,", round(freed / 1e6, 1), "MB of video removed")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Convert downloaded media to mono audio at a fixed sample rate")
+    parser.add_argument('-d', '--save_directory', help='directory the media was downloaded to', type=str, required=True)
+    parser.add_argument('-o', '--output_directory', default=None, help='where to write the audio. defaults to the save directory', type=str, required=False)
+    parser.add_argument('-r', '--sample_rate', default=16000, help='sample rate of the output', type=int, required=False)
+    parser.add_argument('-f', '--audio_format', default='flac', help='container of the output: flac or wav', type=str, required=False)
+    parser.add_argument('-w', '--workers', default=None, help='number of ffmpeg processes. defaults to the number of cores', type=int, required=False)
+    parser.add_argument('--delete_video', default=False, help='remove a video file once its audio is written', type=bool, required=False)
+    parser.add_argument('-m', '--manifest_path', default=None, help='path of the jsonl record of converted files. defaults to <output_directory>/normalized.jsonl', type=str, required=False)
+
+    args = parser.parse_args()
+    normalize_media(**namespace_to_dict(args))
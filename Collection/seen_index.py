@@ -0,0 +1,46 @@
+import os
+import sqlite3
+import threading
+
+
+class SeenIndex:
+    # every identifier a search has already looked at (accepted or not), kept in a set and mirrored in sqlite,
+    # plus the newest date seen per query, so a repeated search only asks for items added since then
+    def __init__(self, path):
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS seen (identifier TEXT PRIMARY KEY, accepted INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS watermarks (query TEXT PRIMARY KEY, date TEXT)")
+        self.conn.commit()
+        self.seen = set(r[0] for r in self.conn.execute("SELECT identifier FROM seen"))
+
+    def __contains__(self, identifier):
+        return identifier in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+    def add(self, identifiers, accepted=False):
+        with self.lock:
+            identifiers = [i for i in identifiers if i not in self.seen]
+            self.conn.executemany("INSERT OR IGNORE INTO seen (identifier, accepted) VALUES (?, ?)",
+                                  ((i, int(accepted)) for i in identifiers))
+            self.conn.commit()
+            self.seen.update(identifiers)
+
+    def get_watermark(self, query):
+        with self.lock:
+            row = self.conn.execute("SELECT date FROM watermarks WHERE query = ?", (query,)).fetchone()
+            return None if row is None else row[0]
+
+    def set_watermark(self, query, date):
+        with self.lock:
+            self.conn.execute("INSERT INTO watermarks (query, date) VALUES (?, ?) "
+                              "ON CONFLICT(query) DO UPDATE SET date = excluded.date", (query, date))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,46 @@
+from archive_download import FileClassifier
+
+
+def test_derivatives_take_precedence():
+    classifier = FileClassifier('both')
+    assert classifier.select(['a.avi', 'a.mp4', 'b.wav', 'b.mp3']) == (None, ['a.mp4', 'b.mp3'])
+
+
+def test_derivative_of_an_unwanted_kind_is_ignored():
+    classifier = FileClassifier('audio')
+    assert classifier.select(['a.mp4', 'a.wav']) == (None, ['a.wav'])
+
+
+def test_best_ranked_extension_of_each_kind():
+    # .mkv comes before .avi and .wav before .flac in the extension lists
+    assert FileClassifier('movies').select(['x.avi', 'y.mkv', 'z.MKV']) == (None, ['y.mkv', 'z.MKV'])
+    assert FileClassifier('both').select(['a.avi', 'a.flac', 'a.wav', 'a.mkv']) == (None, ['a.mkv', 'a.wav'])
+
+
+def test_caption_choice():
+    classifier = FileClassifier('both')
+    names = ['a_asr.srt', 'a_align.json', 'a.cc5.srt', 'a.mp4']
+    assert classifier.select(names) == ('a.cc5.srt', ['a.mp4'])
+    assert classifier.select(['a_align.srt', 'a_asr.js']) == ('a_asr.js', [])
+
+
+def test_media_modes():
+    names = ['a.mkv', 'a.wav', 'a.xml', 'a.jpg']
+    assert FileClassifier('both').select(names) == (None, ['a.mkv', 'a.wav'])
+    assert FileClassifier('movies').select(names) == (None, ['a.mkv'])
+    assert FileClassifier('audio').select(names) == (None, ['a.wav'])
+
+
+def test_suffix_of_both_kinds():
+    # .rm, .webm and .3gp are in both extension lists
+    assert FileClassifier('both').classify('a.rm')[0] == 'video'
+    assert FileClassifier('audio').classify('a.rm')[0] == 'audio'
+    for media in ['both', 'movies', 'audio']:
+        assert FileClassifier(media).select(['a.rm']) == (None, ['a.rm'])
+    # each kind keeps its own rank: .3gp is the better video, .webm the better audio
+    assert FileClassifier('movies').select(['a.webm', 'a.3gp']) == (None, ['a.3gp'])
+    assert FileClassifier('audio').select(['a.webm', 'a.3gp']) == (None, ['a.webm'])
+
+
+def test_no_media():
+    assert FileClassifier('both').select(['a.xml', 'a_files.xml', 'a.torrent']) == (None, [])
@@ -0,0 +1,147 @@
+import os
+import time
+import hashlib
+import requests
+from urllib.parse import urlparse
+from governor import Governor
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TransferError(Exception):
+    pass
+
+
+def file_hash(path, algorithm, block_size=1 << 20):
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as fr:
+        for block in iter(lambda: fr.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def verify(path, size=None, md5=None, sha1=None):
+    # the size is compared first since it is free; one checksum is enough, md5 is cheaper than sha1
+    if not os.path.exists(path):
+        return False
+    if size is not None and os.path.getsize(path) != int(size):
+        return False
+    if md5:
+        return file_hash(path, 'md5') == md5
+    if sha1:
+        return file_hash(path, 'sha1') == sha1
+    return True
+
+
+def fetch_range(session, url, path, start=0, end=None, chunk_size=1 << 20, timeout=60, governor=None,
+                progress=None):
+    # appends bytes [start + size of path, end] of url to path, so an interrupted fetch continues where it
+    # stopped. returns the number of bytes written. the size of each block written is also appended to the
+    # progress list if one is given, so the bytes of a fetch that fails halfway are still counted.
+    have = os.path.getsize(path) if os.path.exists(path) else 0
+    first = start + have
+    if end is not None and first > end:
+        return 0
+    headers = {}
+    if first > 0 or end is not None:
+        headers['Range'] = 'bytes={}-{}'.format(first, '' if end is None else end)
+
+    governor = governor or Governor()
+    host = urlparse(url).netloc
+    with governor.slot(host), session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        governor.report(host, r.status_code)
+        if r.status_code == 416 and end is None:
+            # nothing left past the end of the partial file
+            return 0
+        r.raise_for_status()
+        mode = 'ab'
+        if 'Range' in headers and r.status_code != 206:
+            if start > 0 or end is not None:
+                raise TransferError("range requests are not supported for " + url)
+            # the whole file is sent again, start over
+            mode = 'wb'
+        written = 0
+        with open(path, mode) as fw:
+            for block in r.iter_content(chunk_size):
+                fw.write(block)
+                written += len(block)
+                governor.consume(len(block))
+                if progress is not None:
+                    progress.append(len(block))
+    return written
+
+
+def fetch_segments(session, url, path, size, segments, chunk_size=1 << 20, timeout=60, governor=None,
+                   progress=None):
+    # fetches segments of the file into <path>.<k> at the same time, then joins them into path
+    segment_size = -(-size // segments)
+    bounds = [(a, min(a + segment_size, size) - 1) for a in range(0, size, segment_size)]
+    paths = [path + '.' + str(k) for k in range(len(bounds))]
+
+    def fetch(k):
+        return fetch_range(session, url, paths[k], bounds[k][0], bounds[k][1], chunk_size, timeout, governor,
+                           progress)
+
+    with ThreadPoolExecutor(len(bounds)) as executor:
+        written = sum(executor.map(fetch, range(len(bounds))))
+
+    for (a, b), p in zip(bounds, paths):
+        if os.path.getsize(p) != b - a + 1:
+            raise TransferError("segment {} of {} is incomplete".format(p, url))
+    with open(path, 'wb') as fw:
+        for p in paths:
+            with open(p, 'rb') as fr:
+                while True:
+                    block = fr.read(chunk_size)
+                    if not block:
+                        break
+                    fw.write(block)
+    for p in paths:
+        os.remove(p)
+    return written
+
+
+def transfer_file(session, url, path, size=None, md5=None, sha1=None, segments=1, segment_min_bytes=64 << 20,
+                  retries=3, chunk_size=1 << 20, timeout=60, governor=None):
+    # downloads url to path through <path>.part, resuming the partial file with range requests after a
+    # dropped connection or an earlier run. files of at least segment_min_bytes are split into parallel
+    # segments. the result is checked against the size and checksum from the file metadata before it is
+    # moved into place. returns (bytes transferred, seconds); a file that is already complete costs nothing.
+    if verify(path, size, md5, sha1):
+        return 0, 0.0
+    if os.path.dirname(path) != "":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    part = path + '.part'
+    use_segments = (segments > 1) and (size is not None) and (int(size) >= segment_min_bytes)
+
+    start = time.time()
+    # block sizes of all attempts, failed ones included
+    progress = []
+    error = None
+    for attempt in range(retries + 1):
+        try:
+            if use_segments:
+                fetch_segments(session, url, part, int(size), segments, chunk_size, timeout, governor, progress)
+            else:
+                fetch_range(session, url, part, chunk_size=chunk_size, timeout=timeout, governor=governor,
+                            progress=progress)
+            error = None
+            break
+        except TransferError as e:
+            if not use_segments:
+                raise
+            print(e, "- downloading in one piece")
+            use_segments = False
+            error = e
+        except (requests.RequestException, OSError) as e:
+            print(url, "attempt", attempt + 1, "failed:", e)
+            error = e
+            if attempt < retries:
+                time.sleep(min(60, 2 ** attempt))
+    if error is not None:
+        raise TransferError("{}: {}".format(url, error))
+
+    if not verify(part, size, md5, sha1):
+        os.remove(part)
+        raise TransferError("checksum mismatch for " + url)
+    os.replace(part, path)
+    return sum(progress), time.time() - start
@@ -0,0 +1,70 @@
+import os
+import json
+
+
+# custom_id of a request is "<file>::<part index>::<number of parts of the file>"
+def get_custom_id(file_, ip, n_parts):
+    return "{}::{}::{}".format(file_, ip, n_parts)
+
+
+def parse_custom_id(custom_id):
+    file_, ip, n_parts = custom_id.rsplit("::", 2)
+    return file_, int(ip), int(n_parts)
+
+
+def get_batch_request(custom_id, model_name, system_message, instruction, temp):
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model_name,
+            "messages": [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": instruction}
+            ],
+            "temperature": temp,
+            "n": 1,
+        },
+    }
+
+
+class BatchWriter:
+    def __init__(self, path, model_name, system_message, temp):
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.fw = open(path, "w")
+        self.model_name = model_name
+        self.system_message = system_message
+        self.temp = temp
+        self.count = 0
+
+    def write(self, file_, ip, n_parts, instruction):
+        request = get_batch_request(get_custom_id(file_, ip, n_parts), self.model_name, self.system_message,
+                                    instruction, self.temp)
+        self.fw.write(json.dumps(request) + "\n")
+        self.count += 1
+
+    def close(self):
+        self.fw.close()
+
+
+def read_batch_results(path):
+    # yields (file, part index, number of parts, reply message, finish reason, total tokens) for every
+    # successful line of a batch output file. failed requests are reported and skipped.
+    with open(path, "r") as fr:
+        for line in fr:
+            if line.strip() == "":
+                continue
+            result = json.loads(line)
+            file_, ip, n_parts = parse_custom_id(result["custom_id"])
+
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code", 200) != 200:
+                print("BATCH REQUEST FAILED. FILE: {}, PART: {}, ERROR: {}".format(
+                    file_, ip, result.get("error") or response.get("body")))
+                continue
+
+            body = response["body"]
+            reply = body["choices"][0]
+            yield file_, ip, n_parts, reply["message"]["content"], reply["finish_reason"], body["usage"]["total_tokens"]
@@ -0,0 +1,73 @@
+import time
+import random
+import argparse
+import tiktoken
+from chunker import split_transcript
+
+
+def legacy_split(lines_ins, lines_prompt, encoding, limit):
+    # the loop previously duplicated in tagging_annotation.main and filtering_annotate_evaluate.main
+    instruction = "".join(lines_ins + ["\n"])
+    limit -= len(encoding.encode(instruction))
+    encoded_prompt = encoding.encode("".join(lines_prompt))
+    parts = []
+    while len(encoded_prompt) > limit:
+        chunk = encoding.decode(encoded_prompt[:limit])
+        p = chunk.rfind('SPEAKER_')
+        if p < 0:
+            encoded_prompt = encoded_prompt[limit:]
+            continue
+        elif p == 0:
+            p = len(chunk)
+        parts.append(instruction + chunk[:p] + "\n<End of transcript>")
+        encoded_prompt = encoding.encode(chunk[p:] + encoding.decode(encoded_prompt[limit:]))
+    else:
+        parts.append(instruction + encoding.decode(encoded_prompt))
+    return parts
+
+
+def synthetic_transcript(n_tokens, encoding, seed=0):
+    rng = random.Random(seed)
+    words = ["we", "talked", "about", "where", "my", "family", "is", "from", "and", "what", "it", "means",
+             "to", "grow", "up", "here", "honestly", "i", "think", "that", "community", "matters", "a", "lot"]
+    lines, total = [], 0
+    while total < n_tokens:
+        line = "SPEAKER_{:02d}: {}\n".format(rng.randint(0, 5), " ".join(rng.choice(words)
+                                                                         for _ in range(rng.randint(5, 120))))
+        lines.append(line)
+        total += len(encoding.encode(line))
+    return lines
+
+
+def main(n_tokens, limit, repeats, model_name, skip_legacy=False):
+    encoding = tiktoken.encoding_for_model(model_name)
+    lines_ins = ["Annotate the transcript below.\n"]
+
+    for r in range(repeats):
+        lines_prompt = synthetic_transcript(n_tokens, encoding, seed=r)
+
+        start = time.perf_counter()
+        parts = split_transcript(lines_ins, lines_prompt, encoding, limit)
+        new_time = time.perf_counter() - start
+        message = "run {}: chunker {:.3f}s ({} parts, max {} tokens)".format(
+            r, new_time, len(parts), max(n for _, n in parts))
+
+        if not skip_legacy:
+            start = time.perf_counter()
+            legacy_parts = legacy_split(lines_ins, lines_prompt, encoding, limit)
+            legacy_time = time.perf_counter() - start
+            message += ", legacy loop {:.3f}s ({} parts), speedup {:.1f}x".format(
+                legacy_time, len(legacy_parts), legacy_time / new_time)
+        print(message)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--n-tokens', help="tokens per synthetic transcript", type=int, default=100000)
+    parser.add_argument('-l', '--limit', help="token limit per part", type=int, default=5500)
+    parser.add_argument('-r', '--repeats', help="number of synthetic transcripts", type=int, default=3)
+    parser.add_argument('-m', '--model-name', help="model whose tokenizer is used", type=str, default="gpt-4")
+    parser.add_argument('--skip-legacy', default=False, action="store_true")
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,78 @@
+from bisect import bisect_right
+from itertools import accumulate
+
+
+end_of_transcript = "\n<End of transcript>"
+
+
+def get_turn_starts(prompt, tokens, encoding):
+    # token index of every SPEAKER_ turn. a turn whose label shares a token with the previous text
+    # starts at that shared token.
+    token_ends = list(accumulate(len(b) for b in encoding.decode_tokens_bytes(tokens)))
+    prompt_bytes = prompt.encode("utf-8")
+
+    starts = []
+    p = prompt_bytes.find(b"SPEAKER_")
+    while p >= 0:
+        t = bisect_right(token_ends, p)
+        if (len(starts) == 0) or (starts[-1] != t):
+            starts.append(t)
+        p = prompt_bytes.find(b"SPEAKER_", p + 1)
+    return starts
+
+
+def pack_turns(n_tokens, turn_starts, budget):
+    # greedy packing of whole turns into [start, end) token spans of at most `budget` tokens.
+    # a single turn longer than the budget is cut at the budget.
+    spans = []
+    start = 0
+    while n_tokens - start > budget:
+        i = bisect_right(turn_starts, start + budget) - 1
+        end = turn_starts[i] if (i >= 0) and (turn_starts[i] > start) else start + budget
+        spans.append((start, end))
+        start = end
+    spans.append((start, n_tokens))
+    return spans
+
+
+def plan_parts(n_tokens, turn_starts, n_ins, n_end, limit):
+    # token counts of the parts split_transcript makes of a transcript of n_tokens tokens
+    if n_ins + n_tokens + n_end <= limit:
+        return [n_ins + n_tokens + n_end]
+    spans = pack_turns(n_tokens, turn_starts, max(1, limit - n_ins - n_end))
+    return [n_ins + (end - start) + n_end for start, end in spans]
+
+
+def split_transcript(lines_ins, lines_prompt, encoding, limit):
+    # returns [(part, n_tokens)]. the transcript is tokenized once and every part's token count comes
+    # from the token spans, so callers never need to encode a part again.
+    instruction = "".join(lines_ins + ["\n"])
+    prompt = "".join(lines_prompt)
+
+    n_ins = len(encoding.encode(instruction))
+    n_end = len(encoding.encode(end_of_transcript))
+    tokens = encoding.encode(prompt)
+
+    if n_ins + len(tokens) + n_end <= limit:
+        return [(instruction + prompt + end_of_transcript, n_ins + len(tokens) + n_end)]
+
+    budget = max(1, limit - n_ins - n_end)
+    spans = pack_turns(len(tokens), get_turn_starts(prompt, tokens, encoding), budget)
+
+    parts = []
+    for start, end in spans:
+        chunk = encoding.decode(tokens[start:end])
+        parts.append((instruction + chunk + end_of_transcript, n_ins + (end - start) + n_end))
+    return parts
+
+
+def split_tokens(lines_ins, tokens, turn_starts, encoding, limit):
+    # split_transcript of an already tokenized transcript; only the instruction is encoded
+    instruction = "".join(lines_ins + ["\n"])
+    n_ins = len(encoding.encode(instruction))
+    n_end = len(encoding.encode(end_of_transcript))
+    if n_ins + len(tokens) + n_end <= limit:
+        return [(instruction + encoding.decode(tokens) + end_of_transcript, n_ins + len(tokens) + n_end)]
+    spans = pack_turns(len(tokens), turn_starts, max(1, limit - n_ins - n_end))
+    return [(instruction + encoding.decode(tokens[start:end]) + end_of_transcript, n_ins + (end - start) + n_end)
+            for start, end in spans]
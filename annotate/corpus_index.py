@@ -0,0 +1,191 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import tiktoken
+from concurrent.futures import ProcessPoolExecutor
+from chunker import get_turn_starts, plan_parts, split_tokens, split_transcript
+
+
+_encoding = None
+
+
+def init_worker(encoding_name):
+    global _encoding
+    _encoding = tiktoken.get_encoding(encoding_name)
+
+
+def get_speakers(prompt):
+    # same as tagging_annotation.get_speakers
+    speakers = prompt.split("SPEAKER_")
+    return list(set(("SPEAKER_" + l[:2]).lower() for l in speakers if l[:2].isnumeric()))
+
+
+def index_file(path):
+    # runs in a worker process: everything the annotation scripts derive from a transcript's text
+    with open(path, "r") as fr:
+        prompt = fr.read()
+    tokens = _encoding.encode(prompt)
+    stat = os.stat(path)
+    return {
+        "hash": hashlib.sha1(prompt.encode("utf-8")).hexdigest(),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "n_tokens": len(tokens),
+        "speakers": get_speakers(prompt),
+    }, np.asarray(tokens, dtype=np.uint32), np.asarray(get_turn_starts(prompt, tokens, _encoding), dtype=np.uint32)
+
+
+class CorpusIndex:
+    # pre-tokenized transcripts of a directory: tokens and turn starts of all files in two flat uint32 arrays
+    # (tokens.npy, turns.npy, memory mapped) and a manifest.json with each file's offsets into them, its token
+    # count, speakers and content hash
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "manifest.json"), "r") as fr:
+            manifest = json.load(fr)
+        self.encoding_name = manifest["encoding"]
+        self.files = manifest["files"]
+        self.tokens = np.load(os.path.join(index_dir, "tokens.npy"), mmap_mode="r")
+        self.turns = np.load(os.path.join(index_dir, "turns.npy"), mmap_mode="r")
+
+    def __contains__(self, file_):
+        return file_ in self.files
+
+    def is_current(self, file_, path):
+        if file_ not in self.files:
+            return False
+        stat = os.stat(path)
+        entry = self.files[file_]
+        return (entry["size"] == stat.st_size) and (entry["mtime"] == stat.st_mtime)
+
+    def get_tokens(self, file_):
+        entry = self.files[file_]
+        return self.tokens[entry["token_offset"]:entry["token_offset"] + entry["n_tokens"]]
+
+    def get_turn_starts(self, file_):
+        entry = self.files[file_]
+        return self.turns[entry["turn_offset"]:entry["turn_offset"] + entry["n_turns"]]
+
+    def plan(self, file_, n_ins, n_end, limit):
+        # token counts of the parts split_transcript would make, without the text or the tokenizer
+        return plan_parts(self.files[file_]["n_tokens"], self.get_turn_starts(file_).tolist(), n_ins, n_end, limit)
+
+    def split(self, file_, lines_ins, encoding, limit):
+        # split_transcript from the stored tokens
+        return split_tokens(lines_ins, self.get_tokens(file_).tolist(), self.get_turn_starts(file_).tolist(), encoding,
+                            limit)
+
+
+def load_index(index_dir, encoding):
+    # the index of a directory if it was built with this encoding, otherwise None
+    if index_dir == "" or not os.path.exists(os.path.join(index_dir, "manifest.json")):
+        return None
+    index = CorpusIndex(index_dir)
+    if index.encoding_name != encoding.name:
+        print("corpus index {} was built with {}, not {}; ignoring it".format(index_dir, index.encoding_name,
+                                                                              encoding.name))
+        return None
+    return index
+
+
+def get_split(index, dir_path, file_, lines_ins, lines_prompt, encoding, limit):
+    if (index is not None) and index.is_current(file_, os.path.join(dir_path, file_)):
+        return index.split(file_, lines_ins, encoding, limit)
+    return split_transcript(lines_ins, lines_prompt, encoding, limit)
+
+
+def get_tokens(index, dir_path, file_, lines_prompt, encoding):
+    # (tokens, turn starts) of a transcript, from the index if it has the file unchanged
+    if (index is not None) and index.is_current(file_, os.path.join(dir_path, file_)):
+        return index.get_tokens(file_).tolist(), index.get_turn_starts(file_).tolist()
+    prompt = "".join(lines_prompt)
+    tokens = encoding.encode(prompt)
+    return tokens, get_turn_starts(prompt, tokens, encoding)
+
+
+def build_index(dir_path, index_dir, model_name="gpt-4", workers=None):
+    # tokenizes the transcripts of dir_path that are new or changed since the last build in a process pool and
+    # rewrites the index. entries of unchanged files are copied over from the previous index.
+    encoding = tiktoken.encoding_for_model(model_name)
+    os.makedirs(index_dir, exist_ok=True)
+    old = load_index(index_dir, encoding)
+
+    files = sorted(os.listdir(dir_path))
+    reuse = [f for f in files if (old is not None) and old.is_current(f, os.path.join(dir_path, f))]
+    reuse_set = set(reuse)
+    todo = [f for f in files if f not in reuse_set]
+    print("{} files, {} unchanged, {} to tokenize".format(len(files), len(reuse), len(todo)))
+
+    results = {}
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(encoding.name,)) as executor:
+        paths = [os.path.join(dir_path, f) for f in todo]
+        for file_, result in zip(todo, executor.map(index_file, paths, chunksize=16)):
+            results[file_] = result
+
+    entries = {}
+    n_tokens = 0
+    n_turns = 0
+    for file_ in files:
+        if file_ in results:
+            entry = dict(results[file_][0])
+            entry["n_turns"] = len(results[file_][2])
+        else:
+            entry = dict(old.files[file_])
+        entry["token_offset"] = n_tokens
+        entry["turn_offset"] = n_turns
+        n_tokens += entry["n_tokens"]
+        n_turns += entry["n_turns"]
+        entries[file_] = entry
+
+    # written under temporary names first, the old arrays are still mapped while their entries are copied
+    tokens = np.lib.format.open_memmap(os.path.join(index_dir, "tokens.tmp.npy"), mode="w+", dtype=np.uint32,
+                                       shape=(n_tokens,))
+    turns = np.lib.format.open_memmap(os.path.join(index_dir, "turns.tmp.npy"), mode="w+", dtype=np.uint32,
+                                      shape=(n_turns,))
+    for file_, entry in entries.items():
+        if file_ in results:
+            file_tokens, file_turns = results[file_][1], results[file_][2]
+        else:
+            file_tokens, file_turns = old.get_tokens(file_), old.get_turn_starts(file_)
+        tokens[entry["token_offset"]:entry["token_offset"] + entry["n_tokens"]] = file_tokens
+        turns[entry["turn_offset"]:entry["turn_offset"] + entry["n_turns"]] = file_turns
+    tokens.flush()
+    turns.flush()
+    del tokens, turns, old
+
+    os.replace(os.path.join(index_dir, "tokens.tmp.npy"), os.path.join(index_dir, "tokens.npy"))
+    os.replace(os.path.join(index_dir, "turns.tmp.npy"), os.path.join(index_dir, "turns.npy"))
+    with open(os.path.join(index_dir, "manifest.json"), "w") as fw:
+        json.dump({"encoding": encoding.name, "files": entries}, fw)
+    print("indexed {} files, {} tokens".format(len(entries), n_tokens))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d',
+                        '--dir-path',
+                        help="path to the directory of transcript files",
+                        type=str,
+                        required=True)
+    parser.add_argument('-x',
+                        '--index-dir',
+                        help="directory to write the corpus index to",
+                        type=str,
+                        required=True)
+    parser.add_argument('-m',
+                        '--model-name',
+                        help="chat gpt model name whose tokenizer is used",
+                        type=str,
+                        default="gpt-4",
+                        required=False)
+    parser.add_argument('-w',
+                        '--workers',
+                        help="number of tokenizer processes. defaults to the number of cores",
+                        type=int,
+                        default=None,
+                        required=False)
+
+    args = parser.parse_args()
+    build_index(**vars(args))
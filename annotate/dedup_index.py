@@ -0,0 +1,203 @@
+import os
+import re
+import sqlite3
+import hashlib
+import argparse
+import threading
+import numpy as np
+
+
+_RE_SPEAKERS = re.compile(r"speaker_\d+")
+_RE_NON_LETTERS = re.compile(r"[^a-z\s]+")
+
+_PRIME = (1 << 61) - 1
+_NOT_MEDIA = ('.xml', '.sqlite', '.zip', '.torrent', '.txt', '.jpg', '.srt', '.js', '.json', '.jsonl', '.part')
+
+
+def normalize_text(text):
+    # speaker labels, timestamps and punctuation differ between transcriptions of the same recording
+    text = _RE_SPEAKERS.sub(" ", text.lower())
+    return _RE_NON_LETTERS.sub(" ", text).split()
+
+
+def get_shingles(words, k=5):
+    if len(words) < k:
+        return set([" ".join(words)]) if len(words) else set()
+    return set(" ".join(words[i:i + k]) for i in range(len(words) - k + 1))
+
+
+class MinHasher:
+    # minhash signatures of word shingles. the share of equal positions in two signatures estimates the
+    # jaccard similarity of their shingle sets.
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, 1 << 31, num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, num_perm).astype(np.uint64)
+
+    def signature(self, shingles):
+        if len(shingles) == 0:
+            return None
+        x = np.fromiter((int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+                         for s in shingles), dtype=np.uint64, count=len(shingles))
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % _PRIME).min(axis=1)
+
+
+def file_md5(path, block_size=1 << 20):
+    h = hashlib.md5()
+    with open(path, "rb") as fr:
+        for block in iter(lambda: fr.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class DedupIndex:
+    # fingerprints of downloaded media (md5 of the file) and of transcripts (hash of the normalized words plus a
+    # minhash signature). an entry matching an earlier one is recorded as its duplicate. media are keyed by
+    # their file name without extension, so the transcript of a duplicate recording is skipped as well.
+    # a read_only index (for dry runs) finds duplicates the same way but keeps new entries in memory only.
+    def __init__(self, path, threshold=0.8, num_perm=64, bands=16, read_only=False):
+        self.read_only = read_only
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm)
+        self.lock = threading.Lock()
+        self.items = {}
+        self.hashes = {}
+        self.buckets = {}
+        if read_only:
+            self.conn = None
+            if not os.path.exists(path):
+                return
+            conn = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+        else:
+            if os.path.dirname(path) != "":
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS items (name TEXT, kind TEXT, hash TEXT, signature BLOB, "
+                              "size INTEGER, duplicate_of TEXT, PRIMARY KEY (name, kind))")
+            self.conn.commit()
+            conn = self.conn
+
+        for name, kind, h, signature, size, duplicate_of in conn.execute("SELECT * FROM items"):
+            if signature is not None:
+                signature = np.frombuffer(signature, dtype=np.uint64)
+            self.remember(name, kind, h, signature, size, duplicate_of)
+        if read_only:
+            conn.close()
+
+    def remember(self, name, kind, h, signature, size, duplicate_of):
+        self.items[(name, kind)] = (size, duplicate_of)
+        if duplicate_of is not None:
+            return
+        self.hashes.setdefault((kind, h), name)
+        if signature is not None:
+            for band in self.band_keys(signature):
+                self.buckets.setdefault(band, []).append((name, signature))
+
+    def band_keys(self, signature):
+        return [(i, signature[i * self.rows:(i + 1) * self.rows].tobytes()) for i in range(self.bands)]
+
+    def find_original(self, kind, h, signature):
+        if (kind, h) in self.hashes:
+            return self.hashes[(kind, h)]
+        if signature is None:
+            return None
+        for band in self.band_keys(signature):
+            for name, other in self.buckets.get(band, []):
+                if np.mean(signature == other) >= self.threshold:
+                    return name
+        return None
+
+    def add(self, name, kind, h, signature, size):
+        with self.lock:
+            if (name, kind) in self.items:
+                return self.items[(name, kind)][1]
+            duplicate_of = self.find_original(kind, h, signature)
+            if not self.read_only:
+                self.conn.execute("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)",
+                                  (name, kind, h, None if signature is None else signature.tobytes(), size,
+                                   duplicate_of))
+                self.conn.commit()
+            self.remember(name, kind, h, signature, size, duplicate_of)
+            return duplicate_of
+
+    def add_transcript(self, name, text):
+        # returns the transcript (or recording) this one duplicates, or None
+        words = normalize_text(text)
+        h = hashlib.sha1(" ".join(words).encode("utf-8")).hexdigest()
+        duplicate_of = self.add(name, "transcript", h, self.hasher.signature(get_shingles(words)), len(text))
+        if duplicate_of is None:
+            media = self.items.get((os.path.splitext(name)[0], "media"))
+            if media is not None:
+                duplicate_of = media[1]
+        return duplicate_of
+
+    def add_media(self, path):
+        name = os.path.splitext(os.path.basename(path))[0]
+        return self.add(name, "media", file_md5(path), None, os.path.getsize(path))
+
+    def report(self):
+        lines = []
+        for kind in ["media", "transcript"]:
+            entries = [v for (name, k), v in self.items.items() if k == kind]
+            duplicates = [size for size, duplicate_of in entries if duplicate_of is not None]
+            lines.append("{}: {} indexed, {} duplicates, {:.1f} MB in duplicates".format(
+                kind, len(entries), len(duplicates), sum(duplicates) / 1e6))
+        return "\n".join(lines)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+
+
+def build_index(index_path, dir_path="", media_dir="", threshold=0.8):
+    index = DedupIndex(index_path, threshold)
+    if media_dir != "":
+        for identifier in sorted(os.listdir(media_dir)):
+            item_dir = os.path.join(media_dir, identifier)
+            if not os.path.isdir(item_dir):
+                continue
+            for file_ in sorted(os.listdir(item_dir)):
+                if file_.lower().endswith(_NOT_MEDIA):
+                    continue
+                duplicate_of = index.add_media(os.path.join(item_dir, file_))
+                if duplicate_of is not None:
+                    print(identifier, file_, "duplicates", duplicate_of)
+    if dir_path != "":
+        for file_ in sorted(os.listdir(dir_path)):
+            with open(os.path.join(dir_path, file_), "r") as fr:
+                duplicate_of = index.add_transcript(file_, fr.read())
+            if duplicate_of is not None:
+                print(file_, "duplicates", duplicate_of)
+    print(index.report())
+    index.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-x',
+                        '--index-path',
+                        help="path to the sqlite dedup index",
+                        type=str,
+                        required=True)
+    parser.add_argument('-d',
+                        '--dir-path',
+                        help="path to the directory of transcript files",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--media-dir',
+                        help="download directory with one subdirectory of media files per item",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--threshold',
+                        help="estimated share of common word 5-grams above which two transcripts are duplicates",
+                        type=float,
+                        default=0.8,
+                        required=False)
+
+    args = parser.parse_args()
+    build_index(**vars(args))
@@ -7,21 +7,36 @@ import argparse
 import pandas as pd
 import numpy as np
 import tiktoken
+import model_registry
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from batch_api import BatchWriter, read_batch_results
+from dedup_index import DedupIndex
+from prefilter import Prefilter, default_keywords_file
+from corpus_index import load_index, get_split
+from model_registry import RatioTracker
+from planner import get_candidates, plan_job, print_plan, split_adaptive
+from response_cache import ResponseCache
+
+
+system_message = "You are a helpful assistant."
+
+
+# the replies are a few words, model_registry.reserve leaves room for them
+output_ratio = 0.0
 
 
 def get_limit(model_name):
-    if model_name == "gpt-3.5-turbo":
-        return 4096, 4060
-    elif model_name == "gpt-3.5-turbo-16k":
-        return 16384, 16350
-    elif model_name == "gpt-4":
-        return 8192, 8160
-    elif model_name == "gpt-4-32k":
-        return 32768, 32730
+    return model_registry.get_limit(model_name, output_ratio)
+
 
+def get_reply(model_name, instruction, temp, cache=None):
+    if cache is not None:
+        key = cache.key(model_name, system_message, instruction, temp)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
 
-def get_reply(model_name, instruction, temp):
     org = "" # your key
     api_key = "" # your key
     openai.organization = org
@@ -30,7 +45,7 @@ def get_reply(model_name, instruction, temp):
     response = openai.ChatCompletion.create(
       model=model_name,
       messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "system", "content": system_message},
             {"role": "user", "content": instruction}
         ],
       temperature=temp,
@@ -41,20 +56,156 @@ def get_reply(model_name, instruction, temp):
     reply_message = reply['message']['content']
     tokens = response['usage']['total_tokens']
 
+    if cache is not None:
+        cache.put(key, reply_message, reply_finish_reason, tokens)
+
     return reply_message, reply_finish_reason, tokens
 
 
-def main(temperature, instruction, dir_path, save_path, relevant_files="", model_name="gpt-4"):
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+def request_reply(model_name, part, temperature, token_limit, file_, ip, cache=None):
+    flag = True
+    try_count = 0
+    while flag:
+        try:
+            reply_message, reply_finish_reason, tokens = get_reply(model_name, part, temperature, cache)
+            flag = False
+            if reply_finish_reason != 'stop':
+                if tokens > token_limit:
+                    print("Stopped due to token number exceeding limit")
+                else:
+                    print("Stopped unexpectedly")
+        except Exception as e:
+            print(file_, "exception", e)
+            if ("overloaded with other requests" in str(e)) or ("6ms" in str(e)) or \
+                    ("exception Rate limit reached" in str(e)):
+                time.sleep(60)
+                flag = True
+                try_count += 1
+
+            if try_count > 10:
+                print("\nFAILED AFTER RETRYING. FILE: {}, PART: {}".format(file_, ip))
+                return None
+    return reply_message
+
+
+def count_relevance(reply_message):
+    if "yes" in reply_message.lower():
+        return 1
+    elif "no" not in reply_message.lower():
+        print("REPLY UNCLEAR. COUNTING AS IRRELEVANT FILE. THE REPLY: {}".format(reply_message))
+    return 0
+
+
+def vote_order(n_parts):
+    # first, middle and last part, then the midpoints of the gaps left between asked parts
+    order = list(dict.fromkeys([0, n_parts // 2, n_parts - 1]))
+    gaps = [(0, n_parts // 2), (n_parts // 2, n_parts - 1)]
+    while len(gaps):
+        next_gaps = []
+        for a, b in gaps:
+            if b - a > 1:
+                m = (a + b) // 2
+                order.append(m)
+                next_gaps += [(a, m), (m, b)]
+        gaps = next_gaps
+    return order
+
+
+def vote_settled(yes, n_asked, n_parts):
+    # a file is relevant when yes / n_parts >= 0.5. once that holds, or can no longer hold even if every part
+    # not asked yet says yes, the other parts cannot change the decision
+    return (2 * yes >= n_parts) or (2 * (yes + n_parts - n_asked) < n_parts)
+
+
+def main(temperature, instruction, dir_path, save_path, relevant_files="", model_name="gpt-4",
+         cache_path="", cache_max_mb=1024, batch_out="", batch_results="", dedup_index="", prefilter=False,
+         prefilter_model="", keywords_file=default_keywords_file, early_exit=True, concurrency=1, corpus_index="",
+         plan=False, plan_models="", plan_output_ratio=0.01, rpm=200, tpm=40000, latency=5, models=""):
+    # a --plan dry run writes nothing: no output directory, no reply cache, no new dedup entries
+    if not plan:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
     with open(instruction, "r") as fr:
         lines_ins = fr.readlines()
 
     encoding = tiktoken.encoding_for_model(model_name)
+    cache = ResponseCache(cache_path, cache_max_mb * 1024 ** 2) if cache_path != "" and not plan else None
+
+    _, limit = get_limit(model_name)
+    index = load_index(corpus_index, encoding)
+    candidates = get_candidates(models, encoding) if batch_out == "" and batch_results == "" else []
+    ratios = RatioTracker(output_ratio)
 
-    files = os.listdir(dir_path[0])
+    files = os.listdir(dir_path)
     files.sort()
 
-    gt_files = os.listdir(relevant_files)
+    # duplicates of a transcript seen before are left out of requests and of the FP/FN totals
+    duplicates = []
+    if dedup_index != "":
+        dedup = DedupIndex(dedup_index, read_only=plan)
+        unique_files = []
+        for file_ in files:
+            with open(os.path.join(dir_path, file_), "r") as fr:
+                text = fr.read()
+            duplicate_of = dedup.add_transcript(file_, text)
+            if duplicate_of is None:
+                unique_files.append(file_)
+            else:
+                print(file_, "is a duplicate of", duplicate_of, "- skipped")
+                duplicates.append((file_, len(encoding.encode(text))))
+        files = unique_files
+        print("skipped {} duplicate transcripts, {} transcript tokens".format(
+            len(duplicates), sum(n for _, n in duplicates)))
+        print(dedup.report())
+        dedup.close()
+
+    # transcripts the local prefilter rejects are counted as irrelevant without any request. it runs on batch
+    # imports as well, the files it rejected were left out of the batch
+    rejected = {}
+    if prefilter:
+        checker = Prefilter(keywords_file, model_path=prefilter_model)
+        for file_ in files:
+            with open(os.path.join(dir_path, file_), "r") as fr:
+                reason = checker.check(fr.read())
+            if reason is not None:
+                rejected[file_] = reason
+        print("prefilter rejected {} of {} files".format(len(rejected), len(files)))
+
+    if plan:
+        # no requests: parts, tokens, cost and time of the run for every model. with early exit fewer parts
+        # are asked, so these are upper bounds
+        def read_transcripts():
+            for file_ in files:
+                if file_ not in rejected:
+                    with open(os.path.join(dir_path, file_), "r") as fr:
+                        yield file_, fr.readlines()
+
+        print_plan(plan_job(read_transcripts(), lines_ins, plan_models.split() or list(model_registry.models),
+                            get_limit, plan_output_ratio, index, dir_path, candidates, ratios),
+                   rpm, tpm, concurrency, latency)
+        return
+
+    if batch_out != "":
+        writer = BatchWriter(batch_out, model_name, system_message, temperature)
+        for file_ in files:
+            if file_ in rejected:
+                continue
+            with open(os.path.join(dir_path, file_), "r") as fr:
+                lines_prompt = fr.readlines()
+            parts = get_split(index, dir_path, file_, lines_ins, lines_prompt, encoding, limit)
+            for ip, (part, _) in enumerate(parts):
+                writer.write(file_, ip, len(parts), part)
+        writer.close()
+        print("wrote {} batch requests to {}".format(writer.count, batch_out))
+        return
+
+    batch_replies = {}
+    if batch_results != "":
+        for file_, ip, n_parts, reply_message, reply_finish_reason, tokens in read_batch_results(batch_results):
+            if reply_finish_reason != 'stop':
+                print(file_, ip, "Stopped unexpectedly")
+            batch_replies.setdefault(file_, (n_parts, []))[1].append(reply_message)
+
+    gt_files = os.listdir(relevant_files) if relevant_files != "" else []
 
     df_file_spk = {
         "File": [],
@@ -63,91 +214,79 @@ def main(temperature, instruction, dir_path, save_path, relevant_files="", model
 
     fps = 0
     fns = 0
+    prefilter_fns = 0
+    calls_avoided = 0
+    calls_skipped = 0
     total = len(files)
-    with open(save_path, 'w') as fw:
+    executor = ThreadPoolExecutor(concurrency)
+    votes_path = os.path.splitext(save_path)[0] + "_votes.csv"
+    with open(save_path, 'w') as fw, open(votes_path, 'w') as fv:
+        fv.write("File,Parts,Asked,Skipped\n")
         for idx, file_ in enumerate(files):
             df_file_spk["File"].append(file_)
-            with open(os.path.join(dir_path, file_), "r") as fr:
-                lines_prompt = fr.readlines()
 
-            lines = lines_ins + ["\n"] + lines_prompt + ["\n<End of transcript>"]
-            query = "".join(lines)
-
-            encoded_query = encoding.encode(query)
-            print(file_, len(encoded_query))
-
-            token_limit, limit = get_limit(model_name)
-            if len(encoded_query) > limit:
-                instruction = "".join(lines_ins + ["\n"])
-                encoded_instruction = encoding.encode(instruction)
-                n_ins = len(encoded_instruction)
-                limit -= n_ins
-
-                prompt = "".join(lines_prompt)
-                encoded_prompt = encoding.encode(prompt)
-                parts = []
-
-                p = 0
-                while len(encoded_prompt) > limit:
-                    chunk = encoding.decode(encoded_prompt[:limit])
-                    p = chunk.rfind('SPEAKER_')
-                    if p < 0:
-                        # print("P IS LESS THAN 0!!!!!!!!!!!!!!!")
-                        encoded_prompt = encoded_prompt[limit:]
-                        continue
-                    elif p == 0:
-                        # print("P IS ZERO!")
-                        p = len(chunk)
-                    parts.append(instruction + chunk[:p] + "\n<End of transcript>")
-                    encoded_prompt = encoding.encode(chunk[p:] + encoding.decode(encoded_prompt[limit:]))
-                else:
-                    chunk = encoding.decode(encoded_prompt)
-                    parts.append(instruction + chunk)
+            if file_ in rejected:
+                with open(os.path.join(dir_path, file_), "r") as fr:
+                    lines_prompt = fr.readlines()
+                n_parts = len(get_split(index, dir_path, file_, lines_ins, lines_prompt, encoding, limit))
+                calls_avoided += n_parts
+                print(file_, "prefilter:", rejected[file_])
+                if (relevant_files != "") and (file_ in gt_files):
+                    fns += 1
+                    prefilter_fns += 1
+                message = "{} IRRELEVANT, 0.0\n".format(file_)
+                print(message)
+                fw.write(message)
+                continue
 
+            if batch_results != "":
+                n_parts, replies = batch_replies.get(file_, (1, []))
             else:
-                parts = [query]
+                with open(os.path.join(dir_path, file_), "r") as fr:
+                    lines_prompt = fr.readlines()
 
-            relevance_count = 0
-            total_success = 0
-            for ip, part in enumerate(parts):
-                # time.sleep(30)
-                flag = True
-                try_count = 0
-                while flag:
-                    try:
-                        reply_message, reply_finish_reason, tokens = get_reply(model_name, part, temperature)
-                        flag = False
-                        total_success += 1
-                        if reply_finish_reason != 'stop':
-                            if tokens > token_limit:
-                                print("Stopped due to token number exceeding limit")
-                            else:
-                                print("Stopped unexpectedly")
-                    except Exception as e:
-                        print(file_, "exception", e)
-                        if "overloaded with other requests" in str(e):
-                            flag = True
-                        elif ("6ms" in str(e)) or ("exception Rate limit reached" in str(e)):
-                            time.sleep(60)
-                            flag = True
-                            try_count += 1
-
-                        if try_count > 10:
-                            print("\nFAILED AFTER RETRYING. FILE: {}, PART: {}".format(file_, ip))
-                            break
-                        # continue
-                if flag:
-                    continue
-                if "yes" in reply_message.lower():
-                    relevance_count += 1
-                elif "no" not in reply_message.lower():
-                    print("REPLY UNCLEAR. COUNTING AS IRRELEVANT FILE. THE REPLY: {}".format(reply_message))
-
-            if total_success == 0:
-                print("\nFAILED ALL PARTS AFTER RETRYING. FILE: {}".format(file_, ip))
+                if len(candidates):
+                    part_model, _, parts = split_adaptive(candidates, ratios, index, dir_path, file_, lines_ins,
+                                                          lines_prompt, encoding)
+                    print(file_, part_model, sum(n_tokens for _, n_tokens in parts))
+                else:
+                    part_model = model_name
+                    parts = get_split(index, dir_path, file_, lines_ins, lines_prompt, encoding, limit)
+                    print(file_, sum(n_tokens for _, n_tokens in parts))
+                context = model_registry.get_model(part_model)["context"]
+
+                n_parts = len(parts)
+                replies = []
+                yes = 0
+                n_asked = 0
+                order = vote_order(n_parts)
+
+                def ask(ip):
+                    return request_reply(part_model, parts[ip][0], temperature, context, file_, ip, cache)
+
+                # parts are asked `concurrency` at a time until the vote is settled
+                while n_asked < n_parts:
+                    wave = order[n_asked:n_asked + concurrency]
+                    for reply_message in executor.map(ask, wave):
+                        if reply_message is not None:
+                            replies.append(reply_message)
+                            yes += count_relevance(reply_message)
+                    n_asked += len(wave)
+                    if early_exit and vote_settled(yes, n_asked, n_parts):
+                        break
+
+                calls_skipped += n_parts - n_asked
+                fv.write("{},{},{},{}\n".format(file_, n_parts, n_asked, n_parts - n_asked))
+                if n_asked < n_parts:
+                    print(file_, "vote settled after {} of {} parts".format(n_asked, n_parts))
+
+            if len(replies) == 0:
+                print("\nFAILED ALL PARTS AFTER RETRYING. FILE: {}".format(file_))
                 total -= 1
                 continue
-            relevance_count = relevance_count/len(parts)
+            if batch_results != "":
+                yes = sum(count_relevance(reply_message) for reply_message in replies)
+            relevance_count = yes/n_parts
 
             if relevance_count >= 0.5:
                 message = f"RELEVANT, {relevance_count}"
@@ -168,6 +307,20 @@ def main(temperature, instruction, dir_path, save_path, relevant_files="", model
             print(message)
             fw.write(message)
 
+    executor.shutdown()
+    if batch_results == "":
+        print("{} requests skipped by settled votes".format(calls_skipped))
+
+    if prefilter:
+        print("prefilter: {} files rejected, {} requests avoided".format(len(rejected), calls_avoided))
+        if relevant_files != "":
+            n_relevant = sum(file_ in gt_files for file_ in files)
+            print("prefilter FN: {} out of {} relevant files".format(prefilter_fns, n_relevant))
+
+    if cache is not None:
+        print(cache.report())
+        cache.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -205,6 +358,96 @@ if __name__ == '__main__':
                         type=str,
                         default="gpt-4",
                         required=False)
+    parser.add_argument('--cache-path',
+                        help="path to a sqlite file caching replies. re-running over processed files makes no api calls",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--cache-max-mb',
+                        help="size of the reply cache after which the least recently used replies are evicted",
+                        type=int,
+                        default=1024,
+                        required=False)
+    parser.add_argument('--batch-out',
+                        help="write every prepared part to this batch request jsonl file instead of calling the api",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--batch-results',
+                        help="read the replies from this batch output jsonl file instead of calling the api",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--no-early-exit',
+                        help="ask every part of a file even after its vote is settled",
+                        dest='early_exit',
+                        action='store_false')
+    parser.add_argument('-n',
+                        '--concurrency',
+                        help="number of parts of a file asked at the same time",
+                        type=int,
+                        default=1,
+                        required=False)
+    parser.add_argument('--prefilter',
+                        help="reject clearly irrelevant transcripts locally (see prefilter.py) before any request",
+                        action='store_true')
+    parser.add_argument('--prefilter-model',
+                        help="pickled tf-idf + logistic regression model used by the prefilter as well",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--keywords-file',
+                        help="search phrases whose subjects are added to the prefilter lexicon",
+                        type=str,
+                        default=default_keywords_file,
+                        required=False)
+    parser.add_argument('--corpus-index',
+                        help="directory of a corpus index (see corpus_index.py). transcripts found in it unchanged are "
+                             "split from their stored tokens instead of being tokenized again",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--dedup-index',
+                        help="path to a sqlite dedup index (see dedup_index.py). transcripts duplicating one seen "
+                             "before, or whose recording duplicates one, are skipped",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--plan',
+                        help="print the parts, tokens, cost and wall-clock time of the run for every model in "
+                             "--plan-models without making any request",
+                        action='store_true')
+    parser.add_argument('--plan-models',
+                        help="space separated chat gpt models compared by --plan. defaults to all known models",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--plan-output-ratio',
+                        help="expected reply tokens per prompt token, used by --plan",
+                        type=float,
+                        default=0.01,
+                        required=False)
+    parser.add_argument('--rpm',
+                        help="requests per minute allowed by the account, used by --plan",
+                        type=int,
+                        default=200,
+                        required=False)
+    parser.add_argument('--tpm',
+                        help="tokens per minute allowed by the account, used by --plan",
+                        type=int,
+                        default=40000,
+                        required=False)
+    parser.add_argument('--latency',
+                        help="expected seconds per request, used by --plan",
+                        type=float,
+                        default=5,
+                        required=False)
+    parser.add_argument('--models',
+                        help="space separated chat gpt models to choose from for every transcript: the one taking it "
+                             "in the fewest parts, the cheapest of those. not used with --batch-out or --batch-results",
+                        type=str,
+                        default="",
+                        required=False)
 
     args = parser.parse_args()
     main(**vars(args))
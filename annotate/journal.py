@@ -0,0 +1,82 @@
+import os
+import json
+import threading
+
+
+class Journal:
+    # append-only jsonl record of the parsed results of every (file, part) that got a reply.
+    # a run that is restarted with the same journal skips the parts found here.
+    # only the byte offset of each record is kept in memory; results are read back from disk on demand.
+    # a record may carry the model and prompt budget its file was split with and the token counts of its
+    # reply, so a restarted run splits an unfinished file the same way and starts from the same reply lengths.
+    def __init__(self, path):
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.offsets = {}
+        self.n_parts = {}
+        self.splits = {}
+        self.usage = []
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, "rb") as fr:
+                offset = fr.tell()
+                line = fr.readline()
+                while line:
+                    try:
+                        record = json.loads(line)
+                        self.offsets[(record["file"], record["part"])] = offset
+                        self.n_parts[record["file"]] = record["n_parts"]
+                        if "usage" in record:
+                            self.remember(record["file"], record["usage"])
+                    except ValueError:
+                        # the last line is cut short if the previous run was killed while writing it
+                        pass
+                    offset = fr.tell()
+                    line = fr.readline()
+
+        self.fw = open(path, "ab")
+        self.fr = open(path, "rb")
+        end = self.fr.seek(0, os.SEEK_END)
+        if end > 0:
+            self.fr.seek(end - 1)
+            if self.fr.read(1) != b"\n":
+                # start a fresh line, the last record was left unfinished
+                self.fw.write(b"\n")
+                self.fw.flush()
+
+    def is_done(self, file_, part):
+        return (file_, part) in self.offsets
+
+    def is_file_done(self, file_):
+        if file_ not in self.n_parts:
+            return False
+        return all(self.is_done(file_, ip) for ip in range(self.n_parts[file_]))
+
+    def get(self, file_, part):
+        with self.lock:
+            self.fr.seek(self.offsets[(file_, part)])
+            return json.loads(self.fr.readline())["results"]
+
+    def remember(self, file_, usage):
+        self.splits[file_] = (usage["model"], usage["limit"])
+        self.usage.append((usage["model"], usage["prompt_tokens"], usage["completion_tokens"], usage["finish_reason"]))
+
+    def record(self, file_, part, n_parts, results, usage=None):
+        record = {"file": file_, "part": part, "n_parts": n_parts, "results": results}
+        if usage is not None:
+            record["usage"] = usage
+        with self.lock:
+            if usage is not None:
+                self.remember(file_, usage)
+            offset = self.fw.tell()
+            self.fw.write((json.dumps(record) + "\n").encode("utf-8"))
+            self.fw.flush()
+            self.offsets[(file_, part)] = offset
+            self.n_parts[file_] = n_parts
+
+    def close(self):
+        with self.lock:
+            self.fw.close()
+            self.fr.close()
@@ -0,0 +1,76 @@
+import threading
+import numpy as np
+
+
+# context window and usd per 1k (prompt, completion) tokens of the chat models
+models = {
+    "gpt-3.5-turbo": {"context": 4096, "prices": (0.0015, 0.002)},
+    "gpt-3.5-turbo-16k": {"context": 16384, "prices": (0.003, 0.004)},
+    "gpt-4": {"context": 8192, "prices": (0.03, 0.06)},
+    "gpt-4-32k": {"context": 32768, "prices": (0.06, 0.12)},
+}
+
+# tokens of the context left for the system message and the chat format
+reserve = 32
+
+
+def register_model(model_name, context, input_price=None, output_price=None):
+    models[model_name] = {"context": context, "prices": None if input_price is None else (input_price, output_price)}
+
+
+def get_model(model_name):
+    # dated snapshots ("gpt-4-0613") use the entry of the longest model name they start with
+    if model_name in models:
+        return models[model_name]
+    matches = [name for name in models if model_name.startswith(name + "-")]
+    if len(matches) == 0:
+        raise ValueError("unknown model {}, known models are {}. add it with model_registry.register_model".format(
+            model_name, ", ".join(models)))
+    return models[max(matches, key=len)]
+
+
+def get_limit(model_name, output_ratio):
+    # (context window, prompt budget). a prompt of the budget and its reply of output_ratio tokens per prompt
+    # token fit the context together
+    context = get_model(model_name)["context"]
+    return context, int((context - reserve) / (1 + output_ratio))
+
+
+def get_cost(model_name, n_prompt, n_completion):
+    prices = get_model(model_name)["prices"]
+    if prices is None:
+        return None
+    return n_prompt / 1000 * prices[0] + n_completion / 1000 * prices[1]
+
+
+class RatioTracker:
+    # completion tokens per prompt token of the replies of a run. until min_samples replies are seen the prior
+    # is used; after that a high quantile of the observed ratios plus a margin, of the model's own replies if
+    # there are enough, otherwise of all replies. once a reply of a model was cut at the length limit its ratio
+    # is never lower than the prior again.
+    def __init__(self, prior, min_samples=20, quantile=0.95, margin=1.2):
+        self.prior = prior
+        self.min_samples = min_samples
+        self.quantile = quantile
+        self.margin = margin
+        self.ratios = {}
+        self.cut = set()
+        self.lock = threading.Lock()
+
+    def observe(self, model_name, n_prompt, n_completion, finish_reason="stop"):
+        with self.lock:
+            self.ratios.setdefault(model_name, []).append(n_completion / max(1, n_prompt))
+            if finish_reason == "length":
+                self.cut.add(model_name)
+
+    def ratio(self, model_name):
+        with self.lock:
+            observed = self.ratios.get(model_name, [])
+            if len(observed) < self.min_samples:
+                observed = [r for ratios in self.ratios.values() for r in ratios]
+            if len(observed) < self.min_samples:
+                return self.prior
+            ratio = float(np.quantile(observed, self.quantile)) * self.margin
+            if model_name in self.cut:
+                ratio = max(ratio, self.prior)
+            return ratio
@@ -0,0 +1,122 @@
+import os
+import json
+import pickle
+from bisect import bisect_right
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+
+class AliasTrie:
+    # character trie of the alias keys. every terminal node keeps the position of its key in the alias file.
+    def __init__(self, keys):
+        self.root = {}
+        for i, key in enumerate(keys):
+            node = self.root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, i)
+
+    def first_contained_in(self, text):
+        # smallest position of a key that is a substring of text
+        best = self.root.get(None)
+        for start in range(len(text)):
+            node = self.root
+            for ch in text[start:]:
+                node = node.get(ch)
+                if node is None:
+                    break
+                if (None in node) and ((best is None) or (node[None] < best)):
+                    best = node[None]
+        return best
+
+
+class NationalOriginNormalizer:
+    # alias table ("usa" -> "american", ...) with an indexed replacement for the linear scan that returned the
+    # first alias, in file order, that contains a token or is contained in it
+    def __init__(self, aliases):
+        self.aliases = aliases
+        self.keys = list(aliases.keys())
+        self.trie = AliasTrie(self.keys)
+
+        # all keys on one line each, so the first key containing a token is found with a single str.find
+        self.joined = "\n".join(self.keys)
+        self.starts = []
+        p = 0
+        for key in self.keys:
+            self.starts.append(p)
+            p += len(key) + 1
+        self.memo = {}
+
+    def __contains__(self, temp):
+        return temp in self.aliases
+
+    def __getitem__(self, temp):
+        return self.aliases[temp]
+
+    def find_key(self, temp):
+        if temp in self.memo:
+            return self.memo[temp]
+
+        candidates = []
+        if "\n" not in temp:
+            p = self.joined.find(temp)
+            if p >= 0:
+                candidates.append(bisect_right(self.starts, p) - 1)
+        contained = self.trie.first_contained_in(temp)
+        if contained is not None:
+            candidates.append(contained)
+
+        key = self.keys[min(candidates)] if len(candidates) else None
+        self.memo[temp] = key
+        return key
+
+
+class NationalOriginMatcher:
+    # maps a national origin to the index of the closest value of a fixed vocabulary (e.g. the unique human
+    # annotations). only the values sharing a substring with it are scored, and every answer is memoized.
+    def __init__(self, vocabulary):
+        self.vocabulary = [str(u) for u in vocabulary]
+        self.memo = {}
+
+    def best(self, nat, candidates):
+        if len(candidates) == 0:
+            return None
+        scores = [SequenceMatcher(None, nat, self.vocabulary[i]).ratio() for i in candidates]
+        return candidates[scores.index(max(scores))]
+
+    def match(self, nat):
+        if nat in self.memo:
+            return self.memo[nat]
+
+        idx = self.best(nat, [i for i, u in enumerate(self.vocabulary) if (nat in u) or (u in nat)])
+        if idx is None:
+            idx = self.best(nat, [i for i, u in enumerate(self.vocabulary) if (nat[:-1] in u) or (u[:-1] in nat)])
+        if idx is None:
+            idx = len(self.vocabulary)
+
+        self.memo[nat] = idx
+        return idx
+
+
+@lru_cache(maxsize=None)
+def load_normalizer(path):
+    # the alias json is compiled once into a pickled normalizer next to it (<path>.pkl), which is used for as long
+    # as it is newer than the json. the result is also cached per process.
+    if path == "":
+        raise ValueError("no national origin alias file given")
+    compiled_path = path + ".pkl"
+    if os.path.exists(compiled_path) and os.path.getmtime(compiled_path) >= os.path.getmtime(path):
+        try:
+            with open(compiled_path, "rb") as fr:
+                return pickle.load(fr)
+        except Exception as e:
+            print("could not load compiled alias table", compiled_path, e)
+
+    with open(path) as f:
+        normalizer = NationalOriginNormalizer(json.load(f))
+    try:
+        with open(compiled_path, "wb") as fw:
+            pickle.dump(normalizer, fw, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print("could not save compiled alias table", compiled_path, e)
+    return normalizer
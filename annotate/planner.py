@@ -0,0 +1,113 @@
+import os
+import tiktoken
+from chunker import end_of_transcript, get_turn_starts, plan_parts, split_tokens
+from corpus_index import get_tokens
+from model_registry import get_model, get_limit as get_model_limit, get_cost
+
+
+def get_candidates(models, encoding):
+    # the parts are counted with one tokenizer, so every candidate model has to use it
+    candidates = models.split()
+    for model_name in candidates:
+        get_model(model_name)
+        if tiktoken.encoding_for_model(model_name).name != encoding.name:
+            raise ValueError("{} does not use the {} tokenizer of the other models".format(model_name, encoding.name))
+    return candidates
+
+
+def choose_split(n_tokens, turn_starts, n_ins, n_end, candidates, ratios):
+    # (model, prompt budget, part token counts) for a transcript: the candidate that takes it in the fewest parts
+    # without its expected reply running out of context, the cheapest of those. the budget is then lowered as far
+    # as that number of parts allows, which evens out the parts and keeps each clear of the limit.
+    best = None
+    for model_name in candidates:
+        ratio = ratios.ratio(model_name)
+        _, limit = get_model_limit(model_name, ratio)
+        parts = plan_parts(n_tokens, turn_starts, n_ins, n_end, limit)
+        cost = get_cost(model_name, sum(parts), sum(parts) * ratio)
+        key = (len(parts), float("inf") if cost is None else cost)
+        if (best is None) or (key < best[0]):
+            best = (key, model_name, limit, len(parts))
+    _, model_name, limit, n_parts = best
+
+    low = min(limit, n_ins + n_end + -(-n_tokens // n_parts))
+    while low < limit:
+        middle = (low + limit) // 2
+        if len(plan_parts(n_tokens, turn_starts, n_ins, n_end, middle)) <= n_parts:
+            limit = middle
+        else:
+            low = middle + 1
+    return model_name, limit, plan_parts(n_tokens, turn_starts, n_ins, n_end, limit)
+
+
+def split_adaptive(candidates, ratios, index, dir_path, file_, lines_ins, lines_prompt, encoding):
+    # (model, prompt budget, [(part, n_tokens)]) of a transcript split the way choose_split decides
+    instruction = "".join(lines_ins + ["\n"])
+    tokens, turn_starts = get_tokens(index, dir_path, file_, lines_prompt, encoding)
+    model_name, limit, _ = choose_split(len(tokens), turn_starts, len(encoding.encode(instruction)),
+                                        len(encoding.encode(end_of_transcript)), candidates, ratios)
+    return model_name, limit, split_tokens(lines_ins, tokens, turn_starts, encoding, limit)
+
+
+def plan_job(transcripts, lines_ins, models, get_limit, output_ratio=0.15, index=None, dir_path="",
+             candidates=(), ratios=None):
+    # parts and tokens every model would need for the (file_, lines_prompt) pairs of transcripts, split the
+    # way split_transcript splits them, plus an "adaptive" row for choose_split over the candidates. a
+    # transcript is tokenized once per encoding, or not at all if the corpus index has it. projected output is
+    # output_ratio of a part's input, at most what is left of the context.
+    instruction = "".join(lines_ins + ["\n"])
+    encodings = {m: tiktoken.encoding_for_model(m) for m in models}
+    if len(candidates):
+        encodings["adaptive"] = tiktoken.encoding_for_model(candidates[0])
+    fixed = {e.name: (len(e.encode(instruction)), len(e.encode(end_of_transcript))) for e in encodings.values()}
+    plans = {m: {"files": 0, "parts": 0, "input_tokens": 0, "output_tokens": 0, "cost": 0.0} for m in encodings}
+
+    for file_, lines_prompt in transcripts:
+        counted = {}
+        for m, encoding in encodings.items():
+            if encoding.name not in counted:
+                if (index is not None) and (index.encoding_name == encoding.name) and \
+                        index.is_current(file_, os.path.join(dir_path, file_)):
+                    counted[encoding.name] = (index.files[file_]["n_tokens"], index.get_turn_starts(file_).tolist())
+                else:
+                    prompt = "".join(lines_prompt)
+                    tokens = encoding.encode(prompt)
+                    counted[encoding.name] = (len(tokens), get_turn_starts(prompt, tokens, encoding))
+            n_tokens, turn_starts = counted[encoding.name]
+            n_ins, n_end = fixed[encoding.name]
+
+            if m == "adaptive":
+                model_name, limit, parts = choose_split(n_tokens, turn_starts, n_ins, n_end, candidates, ratios)
+                token_limit = get_model(model_name)["context"]
+            else:
+                model_name = m
+                token_limit, limit = get_limit(m)
+                parts = plan_parts(n_tokens, turn_starts, n_ins, n_end, limit)
+            n_output = sum(max(0, min(int(n * output_ratio), token_limit - n)) for n in parts)
+            cost = get_cost(model_name, sum(parts), n_output)
+
+            plan = plans[m]
+            plan["files"] += 1
+            plan["parts"] += len(parts)
+            plan["input_tokens"] += sum(parts)
+            plan["output_tokens"] += n_output
+            plan["cost"] = None if (cost is None) or (plan["cost"] is None) else plan["cost"] + cost
+    return plans
+
+
+def estimate_hours(plan, rpm, tpm, concurrency, latency):
+    # the slowest of the request rate, the token rate and the requests in flight decides the wall-clock time.
+    # a limit of 0 is no limit, as in RateLimiter
+    minutes = max(plan["parts"] / rpm if rpm else 0, plan["input_tokens"] / tpm if tpm else 0)
+    return max(minutes / 60, plan["parts"] * latency / max(1, concurrency) / 3600)
+
+
+def print_plan(plans, rpm, tpm, concurrency, latency):
+    print("{:<20}{:>8}{:>8}{:>14}{:>14}{:>12}{:>9}".format("model", "files", "parts", "input tokens",
+                                                             "output tokens", "cost $", "hours"))
+    for model_name, plan in plans.items():
+        print("{:<20}{:>8}{:>8}{:>14}{:>14}{:>12}{:>9.2f}".format(
+            model_name, plan["files"], plan["parts"], plan["input_tokens"], plan["output_tokens"],
+            "?" if plan["cost"] is None else "{:.2f}".format(plan["cost"]),
+            estimate_hours(plan, rpm, tpm, concurrency, latency)))
+    print("at {} requests/min, {} tokens/min, {} requests in flight of {}s each".format(rpm, tpm, concurrency, latency))
@@ -0,0 +1,210 @@
+import os
+import re
+import pickle
+import argparse
+from collections import Counter
+
+
+default_keywords_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Collection", "keywords.txt")
+
+# words of the search phrases that name the kind of recording rather than its subject
+content_words = ["talk show", "guest talk", "interview", "talks", "talk", "dialogue", "dialog", "tedtalk",
+                 "podcast", "conversation", "discussion", "debate"]
+
+# race and ethnicity vocabulary of the annotation prompt
+race_terms = ["white", "black", "african american", "asian", "american indian", "alaska native", "native hawaiian",
+              "pacific islander", "multiracial", "hispanic", "latinx", "latino", "latina", "ethnicity", "ethnic",
+              "race", "racial", "racism", "immigrant", "immigrants", "immigration", "heritage", "nationality"]
+
+_RE_NON_LETTERS = re.compile(r"[^a-z\s]+")
+_RE_SPEAKER = re.compile(r"SPEAKER_(\d+)")
+
+
+def load_lexicon(keywords_file=default_keywords_file):
+    # the subjects of the search phrases ("korean american talk show" -> "korean american") and the prompt terms
+    lexicon = set(race_terms)
+    if keywords_file != "" and os.path.exists(keywords_file):
+        with open(keywords_file, "r") as fr:
+            for line in fr:
+                phrase = line.strip().lower()
+                for word in content_words:
+                    if phrase.endswith(" " + word):
+                        phrase = phrase[:-len(word) - 1]
+                        break
+                if phrase != "" and phrase not in content_words:
+                    lexicon.add(phrase)
+    return lexicon
+
+
+def get_features(text, lexicon_re):
+    words = _RE_NON_LETTERS.sub(" ", _RE_SPEAKER.sub(" ", text).lower()).split()
+    speakers = _RE_SPEAKER.findall(text)
+    trigrams = [" ".join(words[i:i + 3]) for i in range(len(words) - 2)]
+    return {
+        "words": len(words),
+        "hits": len(lexicon_re.findall(" ".join(words))),
+        "turns": len(speakers),
+        "speakers": len(set(speakers)),
+        "switches": sum(a != b for a, b in zip(speakers, speakers[1:])),
+        # share of repeated word trigrams; lyrics and noise loops repeat a lot
+        "repetition": 1 - len(set(trigrams)) / len(trigrams) if len(trigrams) else 0.0,
+    }
+
+
+class Prefilter:
+    # local check run before the relevance requests. a transcript is rejected as clearly irrelevant when it has
+    # too few words, too few speaker turns, speakers or changes of speaker to be a conversation, mostly repeated
+    # text, no term of the lexicon, or (with a model) a very low predicted probability of being relevant.
+    def __init__(self, keywords_file=default_keywords_file, min_hits=1, min_words=100, min_turns=1, min_speakers=2,
+                 min_switches=1, max_repetition=0.6, model_path="", model_threshold=0.05):
+        lexicon = sorted(load_lexicon(keywords_file), key=len, reverse=True)
+        self.lexicon_re = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in lexicon) + r")\b")
+        self.min_hits = min_hits
+        self.min_words = min_words
+        self.min_turns = min_turns
+        self.min_speakers = min_speakers
+        self.min_switches = min_switches
+        self.max_repetition = max_repetition
+        self.model = None
+        self.model_threshold = model_threshold
+        if model_path != "":
+            with open(model_path, "rb") as fr:
+                self.model = pickle.load(fr)
+
+    def check(self, text):
+        # returns the reason for rejecting the transcript, or None if it should be sent
+        features = get_features(text, self.lexicon_re)
+        if features["words"] < self.min_words:
+            return "{} words".format(features["words"])
+        if features["turns"] < self.min_turns:
+            return "{} speaker turns".format(features["turns"])
+        if features["speakers"] < self.min_speakers:
+            return "{} speakers".format(features["speakers"])
+        if features["switches"] < self.min_switches:
+            return "{} speaker switches".format(features["switches"])
+        if features["repetition"] > self.max_repetition:
+            return "{:.2f} repeated trigrams".format(features["repetition"])
+        if features["hits"] < self.min_hits:
+            return "{} lexicon hits".format(features["hits"])
+        if self.model is not None:
+            p = self.model.predict_proba([text])[0][1]
+            if p < self.model_threshold:
+                return "model probability {:.3f}".format(p)
+        return None
+
+
+def train_model(dir_path, relevant_files, model_path):
+    # tf-idf + logistic regression over the transcripts of dir_path, labeled by the relevant files
+    from sklearn.pipeline import make_pipeline
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+
+    relevant = set(os.listdir(relevant_files))
+    texts, labels = [], []
+    for file_ in sorted(os.listdir(dir_path)):
+        with open(os.path.join(dir_path, file_), "r") as fr:
+            texts.append(fr.read())
+        labels.append(int(file_ in relevant))
+    model = make_pipeline(TfidfVectorizer(sublinear_tf=True, min_df=2, ngram_range=(1, 2), max_features=50000),
+                          LogisticRegression(class_weight="balanced", max_iter=1000))
+    model.fit(texts, labels)
+    with open(model_path, "wb") as fw:
+        pickle.dump(model, fw)
+    print("trained on {} transcripts, {} relevant".format(len(labels), sum(labels)))
+
+
+def main(dir_path, relevant_files="", keywords_file=default_keywords_file, min_hits=1, min_words=100, min_turns=1,
+         min_speakers=2, min_switches=1, max_repetition=0.6, model_path="", model_threshold=0.05, train=False):
+    if train:
+        train_model(dir_path, relevant_files, model_path)
+        return
+
+    prefilter = Prefilter(keywords_file, min_hits, min_words, min_turns, min_speakers, min_switches, max_repetition,
+                          model_path, model_threshold)
+    relevant = set(os.listdir(relevant_files)) if relevant_files != "" else set()
+    reasons = Counter()
+    rejected = []
+    files = sorted(os.listdir(dir_path))
+    for file_ in files:
+        with open(os.path.join(dir_path, file_), "r") as fr:
+            reason = prefilter.check(fr.read())
+        if reason is not None:
+            rejected.append(file_)
+            reasons[re.sub(r"[\d.]+", "", reason).strip()] += 1
+            print(file_, "REJECTED,", reason)
+
+    print("rejected {} of {} files".format(len(rejected), len(files)))
+    for reason, count in reasons.most_common():
+        print("  {}: {}".format(reason, count))
+    if relevant_files != "":
+        fns = sum(file_ in relevant for file_ in rejected)
+        n_relevant = sum(file_ in relevant for file_ in files)
+        print("prefilter FN: {} out of {} relevant files".format(fns, n_relevant))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d',
+                        '--dir-path',
+                        help="path to the directory of transcript files",
+                        type=str,
+                        required=True)
+    parser.add_argument('-f',
+                        '--relevant-files',
+                        help="path to a directory containing only the relevant files. used to report the false "
+                             "negatives of the prefilter and as labels with --train",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('-k',
+                        '--keywords-file',
+                        help="search phrases whose subjects are added to the lexicon",
+                        type=str,
+                        default=default_keywords_file,
+                        required=False)
+    parser.add_argument('--min-hits',
+                        help="fewest lexicon terms a transcript needs to be sent",
+                        type=int,
+                        default=1,
+                        required=False)
+    parser.add_argument('--min-words',
+                        help="fewest words a transcript needs to be sent",
+                        type=int,
+                        default=100,
+                        required=False)
+    parser.add_argument('--min-turns',
+                        help="fewest speaker turns a transcript needs to be sent",
+                        type=int,
+                        default=1,
+                        required=False)
+    parser.add_argument('--min-speakers',
+                        help="fewest distinct speakers a transcript needs to be sent",
+                        type=int,
+                        default=2,
+                        required=False)
+    parser.add_argument('--min-switches',
+                        help="fewest changes of speaker between turns a transcript needs to be sent",
+                        type=int,
+                        default=1,
+                        required=False)
+    parser.add_argument('--max-repetition',
+                        help="largest share of repeated word trigrams a transcript may have to be sent",
+                        type=float,
+                        default=0.6,
+                        required=False)
+    parser.add_argument('--model-path',
+                        help="pickled tf-idf + logistic regression model (written with --train)",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--model-threshold',
+                        help="predicted probability of relevance below which the model rejects a transcript",
+                        type=float,
+                        default=0.05,
+                        required=False)
+    parser.add_argument('--train',
+                        help="train the model on --dir-path labeled by --relevant-files and save it to --model-path",
+                        action='store_true')
+
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,73 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.rate = float(rate_per_minute) / 60.0
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # a single request larger than the bucket is admitted once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class RateLimiter:
+    # requests-per-minute and tokens-per-minute buckets that are always drawn together
+    def __init__(self, rpm=None, tpm=None):
+        self.buckets = []
+        if rpm:
+            self.buckets.append((TokenBucket(rpm), lambda n_tokens: 1))
+        if tpm:
+            self.buckets.append((TokenBucket(tpm), lambda n_tokens: n_tokens))
+        self.lock = threading.Lock()
+
+    def acquire(self, n_tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = 0.0
+                for bucket, cost in self.buckets:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(cost(n_tokens)))
+                if wait == 0.0:
+                    for bucket, cost in self.buckets:
+                        bucket.tokens -= min(cost(n_tokens), bucket.capacity)
+                    return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # called after a rate-limit error so that every worker backs off, not only the one that failed
+        with self.lock:
+            for bucket, _ in self.buckets:
+                bucket.tokens = min(bucket.tokens, 0.0) - bucket.rate * seconds
+
+
+def run_concurrent(jobs, call, limiter=None, concurrency=1):
+    # jobs yields (n_tokens, args). results of call(*args) are yielded in the order of the jobs
+    # while up to `concurrency` requests are in flight. n_tokens=None skips admission (e.g. cached replies).
+    def admitted_call(n_tokens, args):
+        if (limiter is not None) and (n_tokens is not None):
+            limiter.acquire(n_tokens)
+        return call(*args)
+
+    concurrency = max(1, int(concurrency))
+    pending = deque()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for n_tokens, args in jobs:
+            pending.append(executor.submit(admitted_call, n_tokens, args))
+            while len(pending) >= 2 * concurrency:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
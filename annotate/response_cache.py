@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class ResponseCache:
+    # on-disk cache of chat completion replies keyed by a hash of everything that decides the reply.
+    # the least recently used replies are evicted once the stored text exceeds max_bytes.
+    def __init__(self, path, max_bytes=1024 ** 3):
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS replies (key TEXT PRIMARY KEY, reply TEXT, "
+                          "finish_reason TEXT, tokens INTEGER, size INTEGER, accessed REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS replies_accessed ON replies (accessed)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM replies").fetchone()[0]
+
+    @staticmethod
+    def key(model_name, system_message, instruction, temp):
+        payload = json.dumps([model_name, system_message, instruction, float(temp)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def contains(self, key):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM replies WHERE key = ?", (key,)).fetchone() is not None
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT reply, finish_reason, tokens FROM replies WHERE key = ?",
+                                    (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE replies SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0], row[1], row[2]
+
+    def put(self, key, reply_message, reply_finish_reason, tokens):
+        size = len(reply_message.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM replies WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.size -= old[0]
+            self.conn.execute("INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?, ?, ?)",
+                              (key, reply_message, reply_finish_reason, tokens, size, time.time()))
+            self.size += size
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        while self.size > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM replies ORDER BY accessed LIMIT 100").fetchall()
+            if len(rows) == 0:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM replies WHERE key = ?", (key,))
+                self.size -= size
+                if self.size <= self.max_bytes:
+                    break
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return "cache hits: {}, misses: {}, hit rate: {:.2f}".format(self.hits, self.misses, rate)
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
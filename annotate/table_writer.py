@@ -0,0 +1,41 @@
+import os
+
+
+class TableWriter:
+    # appends DataFrames to a csv or parquet file and flushes after every write,
+    # so the rows of a long run can be read while it is still going
+    def __init__(self, path, columns, output_format="csv"):
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.columns = columns
+        self.output_format = output_format
+        self.header = True
+        self.writer = None
+
+        if output_format == "csv":
+            self.fw = open(path, "w", newline="")
+        elif output_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self.pa = pa
+            self.schema = pa.schema([(c, pa.string()) for c in columns])
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            raise ValueError("unknown output format: {}".format(output_format))
+
+    def write(self, df):
+        df = df.astype(str)
+        df.columns = self.columns
+        if self.output_format == "csv":
+            df.to_csv(self.fw, index=False, header=self.header)
+            self.fw.flush()
+        else:
+            self.writer.write_table(self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+        self.header = False
+
+    def close(self):
+        if self.output_format == "csv":
+            self.fw.close()
+        else:
+            self.writer.close()
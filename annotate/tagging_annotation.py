@@ -7,28 +7,45 @@ import argparse
 import pandas as pd
 import numpy as np
 import tiktoken
-from copy import deepcopy
+import model_registry
+from batch_api import BatchWriter, read_batch_results
+from dedup_index import DedupIndex
+from corpus_index import load_index, get_split
+from journal import Journal
+from model_registry import RatioTracker
+from planner import get_candidates, plan_job, print_plan, split_adaptive
+from response_cache import ResponseCache
+from table_writer import TableWriter
+from request_engine import RateLimiter, run_concurrent
 
 
+system_message = "You are a helpful assistant."
+
 valid_types = ["self-identification", "other-person in-interaction identification",
                "other-person outside-interaction identification", "unknown"]
 valid_ethnicities = ["hispanic or latinx", "non-hispanic or non-latinx", "unknown"]
 valid_races = ["white", "black or african american", "asian", "american indian or alaska native",
                "native hawaiian or other pacific islander", "multiracial", "unknown"]
 
+_RE_BRACKETS = re.compile(r"([\(\[]).*?([\)\]])")
+_RE_NON_LETTERS = re.compile(r"[^a-zA-Z\s]+")
+_RE_COMBINE_WHITESPACE = re.compile(r"\s+")
+
+# reply tokens per prompt token the prompt budget leaves room for until the replies of a run say otherwise
+output_ratio = 0.5
+
 
 def get_limit(model_name):
-    if model_name == "gpt-3.5-turbo":
-        return 4096, 2730
-    elif model_name == "gpt-3.5-turbo-16k":
-        return 16384, 11000
-    elif model_name == "gpt-4":
-        return 8192, 5500
-    elif model_name == "gpt-4-32k":
-        return 32768, 22000
+    return model_registry.get_limit(model_name, output_ratio)
 
 
-def get_reply(model_name, instruction, temp):
+def get_reply(model_name, instruction, temp, cache=None):
+    if cache is not None:
+        key = cache.key(model_name, system_message, instruction, temp)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
     org = "" # your organization key
     api_key = "" # your api key
     openai.organization = org
@@ -37,7 +54,7 @@ def get_reply(model_name, instruction, temp):
     response = openai.ChatCompletion.create(
       model=model_name,
       messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "system", "content": system_message},
             {"role": "user", "content": instruction}
         ],
       temperature=temp,
@@ -48,6 +65,9 @@ def get_reply(model_name, instruction, temp):
     reply_message = reply['message']['content']
     tokens = response['usage']['total_tokens']
 
+    if cache is not None:
+        cache.put(key, reply_message, reply_finish_reason, tokens)
+
     return reply_message, reply_finish_reason, tokens
 
 
@@ -138,240 +158,281 @@ def get_speakers(lines):
     return speakers
 
 
+def match_valid(temp, valid_vals):
+    for val in valid_vals:
+        if (temp in val) or (val in temp):
+            return val
+    return None
+
+
 def split_multiples(df, col, valid_vals):
-    df_extended = []
-    for i in range(df.shape[0]):
-        temp = str(df[i, col])
-        temp = re.sub("([\(\[]).*?([\)\]])", "", temp)
-        temp = str(temp).replace("/", ",").replace("&", ",")
-        temps = temp.split(",")
-        for t, temp in enumerate(temps):
-            temp = re.sub('[^a-zA-Z\s]+', " ", temp)
-            _RE_COMBINE_WHITESPACE = re.compile(r"\s+")
-            temp = _RE_COMBINE_WHITESPACE.sub(" ", temp).strip()
-
-            if valid_vals is None:
-                if t == 0:
-                    df[i, col] = temp
-                else:
-                    row = deepcopy(df[i, :])
-                    row[col] = temp
-                    df_extended.append(row.tolist())
-            else:
-                flag = False
-                for j in range(len(valid_vals)):
-                    if (temp in valid_vals[j]) or (valid_vals[j] in temp):
-                        if t == 0:
-                            df[i, col] = valid_vals[j]
-                        else:
-                            row = deepcopy(df[i, :])
-                            row[col] = valid_vals[j]
-                            df_extended.append(row.tolist())
-                        flag = True
-                        break
-                if not flag:
-                    print("INVALID RACE: ", df[i, col])
-                    if t == 0:
-                        df[i, col] = temp
-                    else:
-                        row = deepcopy(df[i, :])
-                        row[col] = temp
-                        df_extended.append(row.tolist())
-
-    if df_extended != []:
-        df = np.concatenate((df, np.array(df_extended)), axis=0)
+    # splits multi-valued cells ("asian/white") into one row per value. the first value stays in place and the
+    # other values are appended after all the original rows, in row order.
+    values = df[col].astype(str).str.replace(_RE_BRACKETS, "", regex=True)
+    values = values.str.replace("/", ",", regex=False).str.replace("&", ",", regex=False)
 
-    return df
+    df = df.reset_index(drop=True)
+    df[col] = values.str.split(",").values
+    df = df.explode(col)
+    piece_idx = df.groupby(level=0).cumcount().values
 
+    values = df[col].astype(str).str.replace(_RE_NON_LETTERS, " ", regex=True)
+    values = values.str.replace(_RE_COMBINE_WHITESPACE, " ", regex=True).str.strip()
 
-def post_process(df):
-    df = df.values
-    df[np.where((df == "unknown") | (df == "Unknown") | (df == "n/a") | (df == "na")
-                | (df == "N/A") | (df == "NA"))] = "unknown"
-    file, source, target, ethnicity, national_origin, race, type, line = np.arange(df.shape[-1]).tolist()
-    idx = (df[:, source] != "unknown") & (df[:, line] != "unknown") \
-          & (df[:, line] != "") & ((df[:, national_origin] != "unknown")
-                                           | (df[:, race] != "unknown"))
-
-    df = df[idx, :]
-    df_del = []
-
-    for i in range(df.shape[0]):
-        temp = str(df[i, type]).lower()
-        temp = re.sub("([\(\[]).*?([\)\]])", "", temp)
-        if (temp in valid_types[0].lower()) or (valid_types[0].lower() in temp):
-            df[i, type] = valid_types[0]
-        elif (temp in valid_types[1].lower()) or (valid_types[1].lower() in temp):
-            df[i, type] = valid_types[1]
-        elif (temp in valid_types[2].lower()) or (valid_types[2].lower() in temp):
-            df[i, type] = valid_types[2] 
-        else:
-            df[i, type] = "unknown"
-            df_del.append(i)
-    df = np.delete(df, (df_del), axis=0)
+    if valid_vals is not None:
+        lookup = {}
+        for temp in values.unique():
+            lookup[temp] = match_valid(temp, valid_vals)
+            if lookup[temp] is None:
+                print("INVALID RACE: ", temp)
+                lookup[temp] = temp
+        values = values.map(lookup)
 
-    idx2 = np.where(df[:, type] == "self-identification")
-    df[idx2, target] = df[idx2, source]
+    df[col] = values.values
+    df = df.iloc[np.argsort(piece_idx > 0, kind="stable")]
+    return df.reset_index(drop=True)
+
+
+def post_process(df):
+    file, source, target, ethnicity, national_origin, race, type, line = df.columns
+    df = df.mask(df.isin(["unknown", "Unknown", "n/a", "na", "N/A", "NA"]), "unknown")
+    idx = (df[source] != "unknown") & (df[line] != "unknown") \
+          & (df[line] != "") & ((df[national_origin] != "unknown")
+                                | (df[race] != "unknown"))
+    df = df[idx]
+
+    types = df[type].astype(str).str.lower().str.replace(_RE_BRACKETS, "", regex=True)
+    lookup = {temp: match_valid(temp, valid_types[:3]) for temp in types.unique()}
+    types = types.map(lookup)
+    df = df[types.notna()].copy()
+    df[type] = types[types.notna()]
+
+    idx2 = df[type] == "self-identification"
+    df.loc[idx2, target] = df.loc[idx2, source]
 
     df = split_multiples(df, race, valid_races)
     df = split_multiples(df, national_origin, None)
     return df
 
 
-def main(temperature, instruction, dir_path, save_path, selected_files="", model_name="gpt-4"):
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+def get_parts(file_, lines_ins, lines_prompt, encoding, limit, index=None, dir_path=""):
+    parts = get_split(index, dir_path, file_, lines_ins, lines_prompt, encoding, limit)
+    print(file_, sum(n_tokens for _, n_tokens in parts))
+    return parts
+
+
+def request_reply(model_name, part, temperature, token_limit, file_, limiter=None, cache=None):
+    while True:
+        try:
+            reply_message, reply_finish_reason, tokens = get_reply(model_name, part, temperature, cache)
+            if reply_finish_reason != 'stop':
+                if tokens > token_limit:
+                    print("Stopped due to token number exceeding limit")
+                else:
+                    print("Stopped unexpectedly")
+            return reply_message, reply_finish_reason, tokens
+        except Exception as e:
+            print(file_, "exception", e)
+            # an overloaded server is backed off from like a rate limit, not hammered with retries
+            if ("overloaded with other requests" in str(e)) or ("6ms" in str(e)) or \
+                    ("rate limit reached" in str(e).lower()):
+                if limiter is not None:
+                    limiter.pause(65)
+                time.sleep(65)
+                continue
+            raise
+
+
+def annotate_part(model_name, part, temperature, token_limit, file_, limiter, cache=None):
+    # returns the results, finish reason and total tokens of the reply, or Nones
+    try:
+        reply_message, reply_finish_reason, tokens = request_reply(model_name, part, temperature, token_limit, file_,
+                                                                   limiter, cache)
+        return get_results(reply_message, file_), reply_finish_reason, tokens
+    except Exception as e:
+        print("EXCEPTION:", e)
+        return None, None, None
+
+
+def main(temperature, instruction, dir_path, save_path, selected_files="", model_name="gpt-4",
+         concurrency=8, rpm=200, tpm=40000, api_base="", cache_path="", cache_max_mb=1024,
+         journal_path="", batch_out="", batch_results="", dedup_index="", corpus_index="", plan=False, plan_models="",
+         plan_output_ratio=0.15, latency=30, models=""):
+    # a --plan dry run writes nothing: no output directory, no reply cache, no new dedup entries
+    if not plan:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
     with open(instruction, "r") as fr:
         lines_ins = fr.readlines()
 
+    if api_base != "":
+        openai.api_base = api_base
+
     encoding = tiktoken.encoding_for_model(model_name)
-    df = {"File": [], "Source": [], "Target": [], "Ethnicity": [],
-          "National Origin": [], "Race": [], "Type": [], "Line": []}
+    _, limit = get_limit(model_name)
+    limiter = RateLimiter(rpm, tpm)
+    index = load_index(corpus_index, encoding)
+    # batch runs keep to model_name and its fixed budget, the batch results have to match the parts written
+    candidates = get_candidates(models, encoding) if batch_out == "" and batch_results == "" else []
+    ratios = RatioTracker(output_ratio)
+    cache = ResponseCache(cache_path, cache_max_mb * 1024 ** 2) if cache_path != "" and not plan else None
+    if journal_path == "":
+        journal_path = save_path.replace("." + save_path.split(".")[-1], "_journal.jsonl")
+    dedup = DedupIndex(dedup_index, read_only=plan) if dedup_index != "" else None
+    duplicates = []
 
     files = os.listdir(dir_path)
     files.sort()
 
     if selected_files != "":
         if "/" in selected_files:
-            do_files = [d.replace(d.split(".")[-1], "txt") for d in os.listdir(selected_files)]
+            do_files = set(d.replace(d.split(".")[-1], "txt") for d in os.listdir(selected_files))
         else:
-            do_files = selected_files.split()
+            do_files = set(selected_files.split())
 
-    df_file_spk = {
-        "File": [],
-        "Speakers": [],
-    }
+    def read_transcripts():
+        for file_ in files:
+            if selected_files != "":
+                if file_ not in do_files:
+                    continue
 
-    count=0
-    for idx, file_ in enumerate(files):
-        if selected_files != "":
-            if file_ not in do_files:
+            try:
+                with open(os.path.join(dir_path, file_), "r") as fr:
+                    lines_prompt = fr.readlines()
+            except:
                 continue
 
-        df_file_spk["File"].append(file_)
-        try:
-            with open(os.path.join(dir_path, file_), "r") as fr:
-                lines_prompt = fr.readlines()
-        except:
-            continue
-
-        speakers = get_speakers(lines_prompt)
-        df_file_spk["Speakers"].append(speakers)
-
-        lines = lines_ins + ["\n"] + lines_prompt + ["\n<End of transcript>"]
-        query = "".join(lines)
-
-        encoded_query = encoding.encode(query)
-        print(file_, len(encoded_query))
-
-        token_limit, limit = get_limit(model_name)
-        if len(encoded_query) > limit:
-            instruction = "".join(lines_ins + ["\n"])
-            encoded_instruction = encoding.encode(instruction)
-            n_ins = len(encoded_instruction)
-            limit -= n_ins
-
-            prompt = "".join(lines_prompt)
-            encoded_prompt = encoding.encode(prompt)
-            parts = []
-
-            p = 0
-            while len(encoded_prompt) > limit:
-                chunk = encoding.decode(encoded_prompt[:limit])
-                p = chunk.rfind('SPEAKER_')
-                if p < 0:
-                    # print("P IS LESS THAN 0!!!!!!!!!!!!!!!")
-                    encoded_prompt = encoded_prompt[limit:]
+            if dedup is not None:
+                duplicate_of = dedup.add_transcript(file_, "".join(lines_prompt))
+                if duplicate_of is not None:
+                    print(file_, "is a duplicate of", duplicate_of, "- skipped")
+                    duplicates.append((file_, len(encoding.encode("".join(lines_prompt)))))
                     continue
-                elif p == 0:
-                    # print("P IS ZERO!")
-                    p = len(chunk)
-                parts.append(instruction + chunk[:p] + "\n<End of transcript>")
-                encoded_prompt = encoding.encode(chunk[p:] + encoding.decode(encoded_prompt[limit:]))
-            else:
-                chunk = encoding.decode(encoded_prompt)
-                parts.append(instruction + chunk)
+            yield file_, lines_prompt
+
+    def jobs():
+        # parts already in the journal are passed through without a request so that every file
+        # still comes out of the pipeline, in order
+        for file_, lines_prompt in read_transcripts():
+            speakers = get_speakers(lines_prompt)
+
+            if journal.is_file_done(file_):
+                n_parts = journal.n_parts[file_]
+                for ip in range(n_parts):
+                    yield None, (file_, speakers, ip, n_parts, None, None, None, None)
+                continue
 
+            # a file with parts in the journal is split again with the model and budget of those parts
+            if file_ in journal.splits:
+                part_model, part_limit = journal.splits[file_]
+                parts = get_parts(file_, lines_ins, lines_prompt, encoding, part_limit, index, dir_path)
+            elif len(candidates):
+                part_model, part_limit, parts = split_adaptive(candidates, ratios, index, dir_path, file_, lines_ins,
+                                                               lines_prompt, encoding)
+                print(file_, part_model, sum(n_tokens for _, n_tokens in parts))
+            else:
+                part_model, part_limit = model_name, limit
+                parts = get_parts(file_, lines_ins, lines_prompt, encoding, limit, index, dir_path)
+            for ip, (part, n_tokens) in enumerate(parts):
+                n_admit = n_tokens
+                if journal.is_done(file_, ip) or (batch_results != ""):
+                    # no request is made for this part
+                    n_admit = None
+                elif (cache is not None) and cache.contains(cache.key(part_model, system_message, part, temperature)):
+                    n_admit = None
+                yield n_admit, (file_, speakers, ip, len(parts), part, part_model, part_limit, n_tokens)
+
+    def call(file_, speakers, ip, n_parts, part, part_model, part_limit, n_tokens):
+        if journal.is_done(file_, ip):
+            rd = journal.get(file_, ip)
+        elif batch_results != "":
+            # parts missing from the batch results stay out of the journal and are requested by a later run
+            rd = None
         else:
-            parts = [query]
-
+            context = model_registry.get_model(part_model)["context"]
+            rd, finish_reason, tokens = annotate_part(part_model, part, temperature, context, file_, limiter, cache)
+            if rd is not None:
+                # the prompt count leaves out the system message, which errs on the long side for the reply
+                n_completion = max(0, tokens - n_tokens)
+                ratios.observe(part_model, n_tokens, n_completion, finish_reason)
+                journal.record(file_, ip, n_parts, rd, {"model": part_model, "limit": part_limit,
+                                                        "prompt_tokens": n_tokens, "completion_tokens": n_completion,
+                                                        "finish_reason": finish_reason})
+        return file_, speakers, ip, n_parts, rd
+
+    def group_files(results):
         result_dict = {"File": [], "Source": [], "Target": [], "Ethnicity": [],
                        "National Origin": [], "Race": [], "Type": [], "Line": []}
+        for file_, speakers, ip, n_parts, rd in results:
+            if rd is not None:
+                for key in result_dict.keys():
+                    result_dict[key].extend(rd[key])
+            if ip == n_parts - 1:
+                yield file_, speakers, result_dict
+                result_dict = {"File": [], "Source": [], "Target": [], "Ethnicity": [],
+                               "National Origin": [], "Race": [], "Type": [], "Line": []}
+
+    if plan:
+        # no requests: parts, tokens, cost and time of the run for every model
+        print_plan(plan_job(read_transcripts(), lines_ins, plan_models.split() or list(model_registry.models),
+                            get_limit, plan_output_ratio, index, dir_path, candidates, ratios),
+                   rpm, tpm, concurrency, latency)
+        if dedup is not None:
+            dedup.close()
+        return
+
+    journal = Journal(journal_path)
+    for part_model, n_prompt, n_completion, finish_reason in journal.usage:
+        ratios.observe(part_model, n_prompt, n_completion, finish_reason)
+
+    if batch_out != "":
+        writer = BatchWriter(batch_out, model_name, system_message, temperature)
+        for n_tokens, (file_, speakers, ip, n_parts, part, _, _, _) in jobs():
+            if not journal.is_done(file_, ip):
+                writer.write(file_, ip, n_parts, part)
+        writer.close()
+        journal.close()
+        print("wrote {} batch requests to {}".format(writer.count, batch_out))
+        return
+
+    if batch_results != "":
+        for file_, ip, n_parts, reply_message, reply_finish_reason, tokens in read_batch_results(batch_results):
+            if reply_finish_reason != 'stop':
+                print(file_, ip, "Stopped unexpectedly")
+            journal.record(file_, ip, n_parts, get_results(reply_message, file_))
+
+    ext = save_path.split(".")[-1]
+    output_format = "parquet" if ext == "parquet" else "csv"
+    columns = ["File", "Source", "Target", "Ethnicity", "National Origin", "Race", "Type", "Line"]
+    writer = TableWriter(save_path, columns, output_format)
+    trim_writer = TableWriter(save_path.replace("." + ext, "_trim." + ext), columns, output_format)
+    spk_writer = TableWriter(save_path.replace("." + ext, "_files_speakers." + ext), ["File", "Speakers"],
+                             output_format)
+
+    for file_, speakers, result_dict in group_files(run_concurrent(jobs(), call, limiter, concurrency)):
+        df_modified = modify_results(result_dict)
+        df = pd.DataFrame.from_dict(df_modified)
+        writer.write(df)
+        trim_writer.write(post_process(df))
+        spk_writer.write(pd.DataFrame({"File": [file_], "Speakers": [speakers]}))
 
-        for ip, part in enumerate(parts):
-            try:
-                # print(ip, len(encoding.encode(part)))
-                time.sleep(60)
-                flag = True
-                while flag:
-                    try:
-                        reply_message, reply_finish_reason, tokens = get_reply(model_name, part, temperature)
-                        flag = False
-                        if reply_finish_reason != 'stop':
-                            if tokens > token_limit:
-                                print("Stopped due to token number exceeding limit")
-                            else:
-                                print("Stopped unexpectedly")
-                    except Exception as e:
-                        print(file_, "exception", e)
-                        if "overloaded with other requests" in str(e):
-                            flag = True
-                        elif ("6ms" in str(e)) or ("rate limit reached" in str(e).lower()):
-                            time.sleep(65)
-                            flag = True
-
-                rd = get_results(reply_message, file_)
-
-                result_dict["File"].extend(rd["File"])
-                result_dict["Source"].extend(rd["Source"])
-                result_dict["Target"].extend(rd["Target"])
-                result_dict["Ethnicity"].extend(rd["Ethnicity"])
-                result_dict["National Origin"].extend(rd["National Origin"])
-                result_dict["Race"].extend(rd["Race"])
-                result_dict["Type"].extend(rd["Type"])
-                result_dict["Line"].extend(rd["Line"])
-            except Exception as e:
-                print("EXCEPTION:", e)
-
-        result_dict["File"] = np.array(result_dict["File"])
-        result_dict["Source"] = np.array(result_dict["Source"])
-        result_dict["Target"] = np.array(result_dict["Target"])
-        result_dict["Ethnicity"] = np.array(result_dict["Ethnicity"])
-        result_dict["National Origin"] = np.array(result_dict["National Origin"])
-        result_dict["Race"] = np.array(result_dict["Race"])
-        result_dict["Type"] = np.array(result_dict["Type"])
-        result_dict["Line"] = np.array(result_dict["Line"])
+    writer.close()
+    trim_writer.close()
+    spk_writer.close()
+    journal.close()
 
-        df_modified = modify_results(result_dict)
+    if len(candidates):
+        print("reply tokens per prompt token planned for: " + ", ".join(
+            "{} {:.3f}".format(m, ratios.ratio(m)) for m in candidates))
 
-        df["File"].extend(df_modified["File"])
-        df["Source"].extend(df_modified["Source"])
-        df["Target"].extend(df_modified["Target"])
-        df["Ethnicity"].extend(df_modified["Ethnicity"])
-        df["National Origin"].extend(df_modified["National Origin"])
-        df["Race"].extend(df_modified["Race"])
-        df["Type"].extend(df_modified["Type"])
-        df["Line"].extend(df_modified["Line"])
-
-        if (count+1) % 50 == 0 or (count == 10):
-            df_temp = pd.DataFrame.from_dict(df)
-            ext = save_path.split(".")[-1]
-            df_temp.to_csv(save_path.replace("." + ext, f"_{(count + 1) // 50}." + ext), index=False,
-                           header=["File", "Source", "Target", "Ethnicity", "National Origin", "Race", "Type", "Line"])
-        count += 1
-
-    df = pd.DataFrame.from_dict(df)
-
-    df.to_csv(save_path, index=False,
-              header=["File", "Source", "Target", "Ethnicity", "National Origin", "Race", "Type", "Line"])
-
-    print("\n\nStarting Preprocessing")
-    df = post_process(df)
-    df = pd.DataFrame(df)
-    print("\nFinished Preprocessing")
-    df.to_csv(save_path.replace("."+save_path.split(".")[-1], "_trim."+save_path.split(".")[-1]),
-              index=False, header=["File", "Source", "Target", "Ethnicity", "National Origin", "Race", "Type", "Line"])
-    df_file_spk = pd.DataFrame.from_dict(df_file_spk)
-    df_file_spk.to_csv(save_path.replace("."+save_path.split(".")[-1], "_files_speakers."+save_path.split(".")[-1]), index=False)
+    if dedup is not None:
+        print("skipped {} duplicate transcripts, {} transcript tokens".format(
+            len(duplicates), sum(n for _, n in duplicates)))
+        print(dedup.report())
+        dedup.close()
+
+    if cache is not None:
+        print(cache.report())
+        cache.close()
 
 
 if __name__ == '__main__':
@@ -401,7 +462,8 @@ if __name__ == '__main__':
                         required=False)
     parser.add_argument('-s',
                         '--save-path',
-                        help="path to save the processed csv gpt annotation",
+                        help="path to save the processed csv gpt annotation. rows are appended as each file finishes. "
+                             "a .parquet path writes parquet instead",
                         type=str,
                         required=True)
     parser.add_argument('-m',
@@ -410,6 +472,91 @@ if __name__ == '__main__':
                         type=str,
                         default="gpt-4",
                         required=False)
+    parser.add_argument('-n',
+                        '--concurrency',
+                        help="number of requests kept in flight at the same time",
+                        type=int,
+                        default=8,
+                        required=False)
+    parser.add_argument('--rpm',
+                        help="requests per minute allowed by the account",
+                        type=int,
+                        default=200,
+                        required=False)
+    parser.add_argument('--tpm',
+                        help="tokens per minute allowed by the account",
+                        type=int,
+                        default=40000,
+                        required=False)
+    parser.add_argument('--api-base',
+                        help="base url of the chat completion api, e.g. a local server for testing",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--cache-path',
+                        help="path to a sqlite file caching replies. re-running over processed files makes no api calls",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--cache-max-mb',
+                        help="size of the reply cache after which the least recently used replies are evicted",
+                        type=int,
+                        default=1024,
+                        required=False)
+    parser.add_argument('--journal-path',
+                        help="path to the jsonl journal of finished parts. a restarted run skips the parts found in it. "
+                             "defaults to <save-path>_journal.jsonl",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--batch-out',
+                        help="write every prepared part to this batch request jsonl file instead of calling the api",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--batch-results',
+                        help="read the replies from this batch output jsonl file instead of calling the api",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--corpus-index',
+                        help="directory of a corpus index (see corpus_index.py). transcripts found in it unchanged are "
+                             "split from their stored tokens instead of being tokenized again",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--dedup-index',
+                        help="path to a sqlite dedup index (see dedup_index.py). transcripts duplicating one seen "
+                             "before, or whose recording duplicates one, are skipped",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--plan',
+                        help="print the parts, tokens, cost and wall-clock time of the run for every model in "
+                             "--plan-models without making any request",
+                        action='store_true')
+    parser.add_argument('--plan-models',
+                        help="space separated chat gpt models compared by --plan. defaults to all known models",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument('--plan-output-ratio',
+                        help="expected reply tokens per prompt token, used by --plan",
+                        type=float,
+                        default=0.15,
+                        required=False)
+    parser.add_argument('--latency',
+                        help="expected seconds per request, used by --plan",
+                        type=float,
+                        default=30,
+                        required=False)
+    parser.add_argument('--models',
+                        help="space separated chat gpt models to choose from for every transcript: the one taking it "
+                             "in the fewest parts, the cheapest of those. the prompt budget follows the reply lengths "
+                             "seen so far in the run. not used with --batch-out or --batch-results",
+                        type=str,
+                        default="",
+                        required=False)
 
     args = parser.parse_args()
     main(**vars(args))
@@ -1,22 +1,21 @@
 import copy
 import os
 import re
-import sys
 import json
 from copy import deepcopy
-from difflib import SequenceMatcher
 
 import pandas
 import pandas as pd
 import numpy as np
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from national_origin import NationalOriginMatcher, load_normalizer
 
 
 ############# Change filename here. The file should be a json file mapping various ways of saying a 
 # nationality to that nationality. I.E. America to American, USA to American, United States to American etc.
+# It can also be given with --national_origin_file or the national_origin_file argument. It is loaded on first use.
 valid_national_origin_file = ""
-with open(valid_national_origin_file) as f:
-    valid_national_origins = json.load(f)
 
 valid_types_for_indexing = ["self-identification", "other-person in-interaction identification",
                "other-person outside-interaction identification", "unknown"]
@@ -42,7 +41,7 @@ def split_nats(df, col, valid_vals):
         temp = re.sub("([\(\[]).*?([\)\]])", "", temp)
         temp = str(temp).replace("/", ",").replace("&", ",")
 
-        if re.sub('[^a-zA-Z\s]+', " ", temp.lower()) in valid_vals.keys():
+        if re.sub('[^a-zA-Z\s]+', " ", temp.lower()) in valid_vals:
             df[i, col] = valid_vals[re.sub('[^a-zA-Z\s]+', " ", temp)]
         else:
             temp = str(temp).replace("and", ",").replace(" ", ",")
@@ -64,7 +63,7 @@ def split_nats(df, col, valid_vals):
                 continue
             else:
                 # print("INVALID0 National origin: ", df[i, col])
-                if temp in valid_vals.keys():
+                if temp in valid_vals:
                     if t == 0:
                         df[i, col] = valid_vals[temp]
                     else:
@@ -74,16 +73,15 @@ def split_nats(df, col, valid_vals):
                 else:
                     # print("INVALID1 National origin: ", df[i, col])
                     flag = False
-                    for key in valid_vals.keys():
-                        if (temp in key) or (key in temp):
-                            if t == 0:
-                                df[i, col] = valid_vals[key]
-                            else:
-                                row = deepcopy(df[i, :])
-                                row[col] = valid_vals[key]
-                                df_extended.append(row.tolist())
-                            flag = True
-                            break
+                    key = valid_vals.find_key(temp)
+                    if key is not None:
+                        if t == 0:
+                            df[i, col] = valid_vals[key]
+                        else:
+                            row = deepcopy(df[i, :])
+                            row[col] = valid_vals[key]
+                            df_extended.append(row.tolist())
+                        flag = True
 
                     if not flag:
                         # print("INVALID2 National origin: ", df[i, col])
@@ -152,7 +150,7 @@ def split_races(df, col, valid_vals):
     return df
 
 
-def pre_process(df):
+def pre_process(df, national_origin_file=""):
     # File,Source,Target,Ethnicity,National Origin,Race,Type,Line
     # df = df.values
     df[np.where((df == "unknown") | (df == "Unknown") | (df == "n/a") | (df == "na")
@@ -182,169 +180,214 @@ def pre_process(df):
     df = np.delete(df, (df_del), axis=0)
 
     df = split_races(df, race, valid_races_for_indexing)
-    df = split_nats(df, national_origin, valid_national_origins)
+    df = split_nats(df, national_origin, load_normalizer(national_origin_file or valid_national_origin_file))
     return df
 
 
-def main(file_path_gpt, file_path_human, columns, preprocess=False):
-    df_human = pd.read_csv(file_path_human, header=0, keep_default_na=False, index_col=False)
-    df_human_np = df_human.values
-
-    if preprocess:
-        df_human_np = pre_process(df_human_np)
-        df = pandas.DataFrame(df_human_np)
-        df.to_csv(file_path_human.replace(".csv", "_new.csv"), index=False,
-                  header=["File", "Source", "Target", "Ethnicity", "National Origin", "Race", "Type", "Line"])
-
-    df_gpt = pd.read_csv(file_path_gpt, header=0, keep_default_na=False, index_col=False)
-    df_gpt_np = df_gpt.values  # row x col
+def load_annotations(file_path, preprocess=False, national_origin_file=""):
+    df = pd.read_csv(file_path, header=0, keep_default_na=False, index_col=False)
+    df_np = df.to_numpy(dtype=object)  # row x col
 
     if preprocess:
-        df_gpt_np = pre_process(df_gpt_np)
-        df = pandas.DataFrame(df_gpt_np)
-        df.to_csv(file_path_gpt.replace(".csv", "_new.csv"), index=False,
+        df_np = pre_process(df_np, national_origin_file)
+        df = pandas.DataFrame(df_np)
+        df.to_csv(file_path.replace(".csv", "_new.csv"), index=False,
                   header=["File", "Source", "Target", "Ethnicity", "National Origin", "Race", "Type", "Line"])
 
-    df_gpt_np[np.where(df_gpt_np == "unknown")] = "-1"
-    df_human_np[np.where(df_human_np == "unknown")] = "-1"
-
-    cols = [col_idx[valid_columns.index(i)] for i in columns]
-    cols.sort()
-    df_gpt_np = df_gpt_np[:, [0] + cols]
-    df_human_np = df_human_np[:, [0] + cols]
-
-    columns = ["file"] + columns
-    columns = {columns[i]: i for i in range(len(columns))}
-
-    idx_gpt = np.array([False] * len(df_gpt_np)).astype(bool)
-    idx_human = np.array([False] * len(df_human_np)).astype(bool)
+    df_np[np.where(df_np == "unknown")] = "-1"
+    return df_np
+
+
+def parse_int(value):
+    try:
+        return int(value), True
+    except ValueError:
+        return -1, False
+
+
+def encode_annotations(df_np, is_gpt, codes):
+    # integer-encodes every evaluated column of one annotation table once. each column gets its values and a mask
+    # of the rows whose value could be encoded; national origins stay as text because their encoding depends on
+    # the human rows kept for a column subset. codes is shared between tables so equal strings get equal codes.
+    n = df_np.shape[0]
+    enc = {"valid": {}, "values": {}, "ok": {}}
+    for name in valid_columns:
+        enc["valid"][name] = df_np[:, col_idx[valid_columns.index(name)]] != "-1"
+
+    def encode(name, col, func):
+        values, ok = np.full(n, -1, dtype=np.int64), np.zeros(n, dtype=bool)
+        for i, value in enumerate(df_np[:, col]):
+            values[i], ok[i] = func(str(value))
+        enc["values"][name], enc["ok"][name] = values, ok
+
+    def index_of(vals, value):
+        return (vals.index(value), True) if value in vals else (-1, False)
+
+    def code_of(value):
+        if value == "-1":
+            return -1, True
+        return codes.setdefault(value, len(codes)), True
+
+    def col(name):
+        return col_idx[valid_columns.index(name)]
+
+    encode("file", 0, lambda v: parse_int(v.split(".")[0]))
+    encode("type", col("type"), lambda v: index_of(valid_types, v))
+    encode("ethnicity", col("ethnicity"), code_of)
+    encode("line", col("line"), code_of)
+
+    if is_gpt:
+        encode("id_fier", col("id_fier"), lambda v: parse_int(re.sub('[^0-9]+', "", v.lower())))
+        encode("id_fied", col("id_fied"), lambda v: parse_int(re.sub('[^0-9]+', "", v.lower())))
+        encode("race", col("race"), lambda v: index_of(valid_races, v.replace('alaskan', 'alaska')))
+        enc["has_speaker"] = np.ones(n, dtype=bool)
+    else:
+        encode("id_fier", col("id_fier"), lambda v: parse_int(v.lower().replace("speaker_", "")))
+        encode("id_fied", col("id_fied"), lambda v: parse_int(v.lower().replace("speaker_", ""))
+               if "speaker" in v.lower() else (-1, True))
+        encode("race", col("race"), lambda v: index_of(valid_races, v))
+        enc["has_speaker"] = np.array(["speaker" in str(v).lower() for v in df_np[:, col("id_fied")]], dtype=bool)
+
+    enc["national_origin"] = np.array([str(v) for v in df_np[:, col("national_origin")]], dtype=object)
+    return enc
+
+
+def select_rows(enc, columns):
+    idx = np.zeros(len(enc["values"]["file"]), dtype=bool)
     for i in valid_attr:
-        if i in columns.keys():
-            idx_gpt = idx_gpt | (df_gpt_np[:, columns[i]] != "-1")
-            idx_human = idx_human | (df_human_np[:, columns[i]] != "-1")
-    if "id_fier" in columns.keys():
-        idx_gpt = idx_gpt & (df_gpt_np[:, columns["id_fier"]] != "-1")
-        idx_human = idx_human & (df_human_np[:, columns["id_fier"]] != "-1")
-    elif "id_fied" in columns.keys():
-        idx_gpt = idx_gpt & (df_gpt_np[:, columns["id_fied"]] != "-1")
-        idx_human = idx_human & (df_human_np[:, columns["id_fied"]] != "-1")
-
-    df_gpt_np = df_gpt_np[idx_gpt, :]
-    df_human_np = df_human_np[idx_human, :]
-
-    if "national_origin" in columns.keys():
-        nat_unique, nat_inv = np.unique(df_human_np[:, columns["national_origin"]], return_inverse=True)
-        df_human_np[:, columns["national_origin"]] = nat_inv
-
-    idx_gpt = []
-    idx_human = []
-
-    for i in range(df_gpt_np.shape[0]):
-        df_gpt_np[i, columns["file"]] = int(df_gpt_np[i, columns["file"]].split(".")[0])
-        if "id_fied" in columns.keys():
-            try:
-                temp_spk =  re.sub('[^0-9]+', "", df_gpt_np[i, columns["id_fied"]].lower())
-                df_gpt_np[i, columns["id_fied"]] = int(temp_spk)
-            except Exception as e:
-                if temp_spk == "":
-                    # print("exception spk gpt: empty")
-                    idx_gpt.append(i)
-                else:
-                    # print("exception spk gpt", e, x)
-                    df_gpt_np[i, columns["id_fied"]] = "-1"
-                    if "id_fier" not in columns.keys():
-                        idx_gpt.append(i)
-                        continue
-        if "id_fier" in columns.keys():
-            try:
-                df_gpt_np[i, columns["id_fier"]] = int(re.sub('[^0-9]+', "", df_gpt_np[i, columns["id_fier"]].lower()))
-            except:
-                idx_gpt.append(i)
-                continue
-
-        if "type" in columns.keys():
-            df_gpt_np[i, columns["type"]] = valid_types.index(df_gpt_np[i, columns["type"]])
-
-        if "race" in columns.keys():
-            try:
-                df_gpt_np[i, columns["race"]] = valid_races.index(df_gpt_np[i, columns["race"]].replace('alaskan', 'alaska'))
-            except Exception as e:
-                # print(e, df_gpt_np[i, columns["race"]])
-                idx_gpt.append(i)
-        if "national_origin" in columns.keys():
-            nat = str(df_gpt_np[i, columns["national_origin"]])
-            scores = np.array([SequenceMatcher(None, nat, u).ratio() for u in nat_unique])
-            nat_idx = np.arange(len(scores))
-            bools = np.array([(nat in u) or (u in nat) for u in nat_unique.tolist()]).astype(bool)
-            if bools.astype(int).sum() > 0:
-                scores = scores[np.argwhere(bools == True)]
-                nat_idx = nat_idx[np.argwhere(bools == True)]
-                nat_idx_max = nat_idx[np.argmax(scores)]
-                df_gpt_np[i, columns["national_origin"]] = nat_idx_max
-            else:
-                bools = np.array([(nat[:-1] in u) or (u[:-1] in nat) for u in nat_unique.tolist()]).astype(bool)
-                if bools.astype(int).sum() > 0:
-                    scores = scores[np.argwhere(bools == True)]
-                    nat_idx = nat_idx[np.argwhere(bools == True)]
-                    nat_idx_max = nat_idx[np.argmax(scores)]
-                    df_gpt_np[i, columns["national_origin"]] = nat_idx_max
-                else:
-                    df_gpt_np[i, columns["national_origin"]] = len(nat_unique)  # is it the right thing to use -1???
-
-    for i in range(df_human_np.shape[0]):
-        df_human_np[i, columns["file"]] = int(df_human_np[i, columns["file"]].split(".")[0])
-        # if df_human_np[i, columns["file"]] not in picked_files:
-        #     idx_human.append(i)
-        if "id_fied" in columns.keys():
-            if "speaker" not in df_human_np[i, columns["id_fied"]].lower():
-                # print("exception spk human: speaker not in value", df_human_np[i, columns["id_fied"]].lower())
-                df_human_np[i, columns["id_fied"]] = "-1"
-                if "id_fier" not in columns.keys():
-                    idx_human.append(i)
-                    continue
-            df_human_np[i, columns["id_fied"]] = int(df_human_np[i, columns["id_fied"]].lower().replace("speaker_", ""))
-
-        if "id_fier" in columns.keys():
-            df_human_np[i, columns["id_fier"]] = int(df_human_np[i, columns["id_fier"]].lower().replace("speaker_", ""))
-
-        if "type" in columns.keys():
-            df_human_np[i, columns["type"]] = valid_types.index(df_human_np[i, columns["type"]])
-
-        if "race" in columns.keys():
-            try:
-                df_human_np[i, columns["race"]] = valid_races.index(df_human_np[i, columns["race"]])
-            except Exception as e:
-                # print(e)
-                idx_human.append(i)
-
-    df_gpt_np = np.delete(df_gpt_np, (idx_gpt), axis=0)
-    df_human_np = np.delete(df_human_np, (idx_human), axis=0)
-
-    df_human_np = np.unique(df_human_np.astype(int), axis=0)
-    df_gpt_np = np.unique(df_gpt_np.astype(int), axis=0)
-    # print("shape after", df_gpt_np.shape, df_human_np.shape)
-    np.set_printoptions(threshold=sys.maxsize)
-
-    nrows, ncols = max(df_gpt_np.shape[0], df_human_np.shape[0]), df_gpt_np.shape[1]
-    dtype = {'names': ['f{}'.format(i) for i in range(ncols)],
-             'formats': ncols * [df_gpt_np.dtype]}
-
-    common_rows = np.intersect1d(df_gpt_np.view(dtype), df_human_np.view(dtype))
-
-    common_rows = common_rows.view(df_gpt_np.dtype).reshape(-1, ncols)
-    tp = common_rows.shape[0]
-    fp = df_gpt_np.shape[0] - tp
-    fn = df_human_np.shape[0] - tp
-
-    print("Precision: ", tp / (tp + fp), "Recall: ", tp / (tp + fn), "F1: ", tp / (tp + ((fp + fn) / 2)))
+        if i in columns:
+            idx = idx | enc["valid"][i]
+    if "id_fier" in columns:
+        idx = idx & enc["valid"]["id_fier"]
+    elif "id_fied" in columns:
+        idx = idx & enc["valid"]["id_fied"]
+    return idx
+
+
+def get_scores(tp, fp, fn):
+    precision = tp / (tp + fp) if tp + fp else float("nan")
+    recall = tp / (tp + fn) if tp + fn else float("nan")
+    f1 = tp / (tp + ((fp + fn) / 2)) if tp + fp + fn else float("nan")
+    return precision, recall, f1
+
+
+def evaluate(enc_gpt, enc_human, columns, per_file=False):
+    cols = sorted(columns, key=lambda c: col_idx[valid_columns.index(c)])
+    idx_gpt = select_rows(enc_gpt, columns)
+    idx_human = select_rows(enc_human, columns)
+
+    keep_gpt = idx_gpt & enc_gpt["ok"]["file"]
+    keep_human = idx_human & enc_human["ok"]["file"]
+    for c in cols:
+        if c == "national_origin":
+            continue
+        keep_gpt = keep_gpt & enc_gpt["ok"][c]
+        keep_human = keep_human & enc_human["ok"][c]
+    if ("id_fied" in columns) and ("id_fier" not in columns):
+        keep_human = keep_human & enc_human["has_speaker"]
+
+    rows_gpt = [enc_gpt["values"]["file"]]
+    rows_human = [enc_human["values"]["file"]]
+    for c in cols:
+        if c == "national_origin":
+            # the vocabulary is taken from the human rows kept by the column filter, before any row is dropped
+            nat_unique = np.unique(enc_human["national_origin"][idx_human].astype(str))
+            nat_codes = {u: i for i, u in enumerate(nat_unique.tolist())}
+            nat_matcher = NationalOriginMatcher(nat_unique.tolist())
+            rows_human.append(np.array([nat_codes.get(u, -1) for u in enc_human["national_origin"]], dtype=np.int64))
+            rows_gpt.append(np.array([nat_matcher.match(u) if keep else -1
+                                      for u, keep in zip(enc_gpt["national_origin"], keep_gpt)], dtype=np.int64))
+        else:
+            rows_gpt.append(enc_gpt["values"][c])
+            rows_human.append(enc_human["values"][c])
+
+    rows_gpt = np.unique(np.stack(rows_gpt, axis=1)[keep_gpt], axis=0)
+    rows_human = np.unique(np.stack(rows_human, axis=1)[keep_human], axis=0)
+
+    set_gpt = set(map(tuple, rows_gpt.tolist()))
+    set_human = set(map(tuple, rows_human.tolist()))
+    tp = len(set_gpt & set_human)
+    result = {"tp": tp, "fp": len(set_gpt) - tp, "fn": len(set_human) - tp}
+    result["precision"], result["recall"], result["f1"] = get_scores(result["tp"], result["fp"], result["fn"])
+
+    if per_file:
+        files = {}
+        for row in set_gpt:
+            files.setdefault(row[0], [0, 0, 0])[1] += 1
+        for row in set_human:
+            files.setdefault(row[0], [0, 0, 0])[2] += 1
+        for row in set_gpt & set_human:
+            files[row[0]][0] += 1
+        result["files"] = {}
+        for file_, (tp, n_gpt, n_human) in sorted(files.items()):
+            scores = get_scores(tp, n_gpt - tp, n_human - tp)
+            result["files"][file_] = {"tp": tp, "fp": n_gpt - tp, "fn": n_human - tp,
+                                      "precision": scores[0], "recall": scores[1], "f1": scores[2]}
+    return result
+
+
+def evaluate_task(task):
+    file_path_gpt, enc_gpt, enc_human, columns, per_file = task
+    return file_path_gpt, columns, evaluate(enc_gpt, enc_human, columns, per_file)
+
+
+def write_report(results, report_path):
+    rows = []
+    for file_path_gpt, columns, result in results:
+        row = {"gpt_file": file_path_gpt, "columns": " ".join(columns), "file": "all"}
+        row.update({k: v for k, v in result.items() if k != "files"})
+        rows.append(row)
+        for file_, file_result in result.get("files", {}).items():
+            row = {"gpt_file": file_path_gpt, "columns": " ".join(columns), "file": file_}
+            row.update(file_result)
+            rows.append(row)
+
+    if os.path.dirname(report_path) != "":
+        os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    if report_path.endswith(".json"):
+        with open(report_path, "w") as fw:
+            json.dump(rows, fw, indent=2)
+    else:
+        pd.DataFrame(rows).to_csv(report_path, index=False)
+
+
+def main(file_path_gpt, file_path_human, columns=None, preprocess=False, column_sets=None, report_path="",
+         per_file=False, workers=1, national_origin_file=""):
+    # every gpt file is evaluated on every column subset. each table is read, pre-processed and encoded only once.
+    file_paths_gpt = [file_path_gpt] if isinstance(file_path_gpt, str) else list(file_path_gpt)
+    subsets = [list(columns)] if columns else []
+    subsets += [column_set.split(",") for column_set in (column_sets or [])]
+    if len(subsets) == 0:
+        raise ValueError("no columns to evaluate. use --columns and/or --column_sets")
+
+    codes = {}
+    enc_human = encode_annotations(load_annotations(file_path_human, preprocess, national_origin_file), False, codes)
+    enc_gpts = {path: encode_annotations(load_annotations(path, preprocess, national_origin_file), True, codes) for path in file_paths_gpt}
+
+    tasks = [(path, enc_gpts[path], enc_human, subset, per_file) for path in file_paths_gpt for subset in subsets]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(evaluate_task, tasks))
+    else:
+        results = [evaluate_task(task) for task in tasks]
+
+    for path, subset, result in results:
+        if len(tasks) > 1:
+            print(path, " ".join(subset))
+        print("Precision: ", result["precision"], "Recall: ", result["recall"], "F1: ", result["f1"])
+
+    if report_path != "":
+        write_report(results, report_path)
+    return results
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c',
                         '--file_path_gpt',
-                        help="path to csv annotation from chat gpt",
+                        help="path to csv annotation from chat gpt. several paths are evaluated against the same human file",
                         type=str,
+                        nargs='+',
                         required=True)
     parser.add_argument('-f',
                         '--file_path_human',
@@ -356,8 +399,34 @@ if __name__ == '__main__':
                         help="which attributes to evaluate. valid names: id_fier, id_fied, type, ethnicity, national_origin, race",
                         type=str,
                         nargs='+',
-                        required=True)
+                        required=False)
+    parser.add_argument('-s',
+                        '--column_sets',
+                        help="more attribute subsets to evaluate, each one comma separated, e.g. id_fier,race id_fied,type",
+                        type=str,
+                        nargs='+',
+                        required=False)
+    parser.add_argument('-r',
+                        '--report_path',
+                        help="path to save the precision/recall/F1 matrix as csv, or json if it ends with .json",
+                        type=str,
+                        default="",
+                        required=False)
+    parser.add_argument("--per_file", default=False, action="store_true",
+                        help="add a per-file breakdown of every evaluation to the report")
+    parser.add_argument('-w',
+                        '--workers',
+                        help="number of processes evaluating the matrix",
+                        type=int,
+                        default=1,
+                        required=False)
     parser.add_argument("--preprocess", default=False, action="store_true")
+    parser.add_argument('-n',
+                        '--national_origin_file',
+                        help="json file mapping ways of saying a nationality to that nationality, used by --preprocess",
+                        type=str,
+                        default="",
+                        required=False)
 
 
     args = parser.parse_args()
@@ -0,0 +1,16 @@
+import os
+import pandas as pd
+from tagging_annotation import post_process
+
+
+testdata = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata")
+
+
+def read_csv(name):
+    return pd.read_csv(os.path.join(testdata, name), dtype=str, keep_default_na=False)
+
+
+def test_post_process_golden():
+    # post_process_expected.csv is the output of the row-by-row implementation this one replaced
+    df = post_process(read_csv("post_process_input.csv"))
+    pd.testing.assert_frame_equal(df.astype(str).reset_index(drop=True), read_csv("post_process_expected.csv"))